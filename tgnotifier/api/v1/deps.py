@@ -3,7 +3,7 @@ from aiogram import (
     Bot,
 )
 from tgnotifier.telegram.dispatcher import dispatcher
-from tgnotifier.db.session import db, db_state_default
+from tgnotifier.db.session import db, reset_db_state
 from fastapi import Depends, HTTPException, status
 from typing import Optional
 from datetime import datetime, timedelta
@@ -26,11 +26,6 @@ def get_dispatcher() -> Dispatcher:
 def get_bot() -> Bot:
     return dispatcher.bot
 
-   
-async def reset_db_state():
-    db._state._state.set(db_state_default.copy())
-    db._state.reset()
-
 
 def get_db(db_state=Depends(reset_db_state)):
     try:
@@ -1,4 +1,6 @@
+import os
 import secrets
+import socket
 from typing import List, Optional, Union
 from pydantic import AnyHttpUrl, BaseSettings, PostgresDsn, validator, SecretStr
 
@@ -27,6 +29,8 @@ class Settings(BaseSettings):
     PROJECT_NAME: str = "ScraperBot"
 
     FIRST_CLIENT: Optional[str] = ''
+    # notices about failing sources go there, or to FIRST_CLIENT
+    ADMIN_CHAT_ID: Optional[int] = None
 
     DATABASE_URL: PostgresDsn
     
@@ -41,10 +45,75 @@ class Settings(BaseSettings):
     YOUTUBE_API_KEY: SecretStr
     
     INTERVAL: int = 600
+    # a source is polled every INTERVAL at first, then more often if it publishes
+    # and less often if it doesn't, within these bounds
+    POLL_MIN_INTERVAL: int = 120
+    POLL_MAX_INTERVAL: int = 60 * 60 * 3
+    POLL_BACKOFF: float = 1.5
+    POLL_JITTER: float = 0.1
+    # a source failing BREAKER_THRESHOLD times in a row is probed once per backoff,
+    # the backoff doubles after every failure up to BREAKER_MAX_BACKOFF
+    BREAKER_THRESHOLD: int = 3
+    BREAKER_BACKOFF: int = 600
+    BREAKER_MAX_BACKOFF: int = 60 * 60 * 24
+
+    # a run of a job stops taking sources after JOB_DEADLINE seconds,
+    # a poll of a source is cancelled after SOURCE_TIMEOUT or at the deadline
+    JOB_DEADLINE: int = 540
+    SOURCE_TIMEOUT: int = 120
+    DB_STATEMENT_TIMEOUT: int = 30
+
+    # notifications are sent within Telegram's limits (messages per second)
+    SEND_WORKERS: int = 8
+    TELEGRAM_RATE: float = 30
+    TELEGRAM_CHAT_RATE: float = 1
+    SEND_ATTEMPTS: int = 3
+    SEND_INTERVAL: float = 2.0
+    # time to send the queued messages on shutdown
+    SEND_STOP_TIMEOUT: float = 10.0
+    # messages wait in the outbox table till they are sent, a sender claims up to OUTBOX_BATCH
+    # of them and its claim expires after OUTBOX_TTL if it dies. A message that failed SEND_ATTEMPTS
+    # times in a row is put back for OUTBOX_RETRY_INTERVAL (doubled every time), up to OUTBOX_ATTEMPTS times
+    RUN_SENDER: bool = True
+    OUTBOX_BATCH: int = 100
+    OUTBOX_POLL_INTERVAL: float = 1.0
+    OUTBOX_TTL: int = 300
+    OUTBOX_ATTEMPTS: int = 10
+    OUTBOX_RETRY_INTERVAL: int = 60
+    # '' sends every new item on its own, 'source' packs the items of a source into digests,
+    # 'cycle' packs the items of all sources found by a run of a job
+    DIGEST: str = ''
+
+    # at least FLOOD_MIN_POSTS new posts of a site, with none of the page's posts seen before
+    # or FLOOD_SHARE of them new, are held for confirmation as a likely breakage of its stack
+    FLOOD_MIN_POSTS: int = 5
+    FLOOD_SHARE: float = 0.8
 
     SCRAPER_ATTEMPTS: int = 3
     SCRAPER_INTERVAL: float = 1.0
 
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_READ_TIMEOUT: float = 30.0
+    HTTP_POOL_SIZE: int = 100
+    HTTP_POOL_PER_HOST: int = 4
+
+    SITES_CONCURRENCY: int = 10
+    SITES_HOST_CONCURRENCY: int = 2
+
+    TITLE_CACHE_SIZE: int = 10000
+    TITLE_CACHE_TTL: int = 60 * 60 * 24 * 30
+
+    STACK_CACHE_SIZE: int = 256
+    # 'bs4' or 'lxml', sites may override it
+    SCRAPER_ENGINE: str = 'bs4'
+    # processes parsing pages, 0 parses them in a thread of the app
+    PARSE_WORKERS: int = 0
+
+    # sources are leased to workers in batches, a lease of a crashed worker expires after LEASE_TTL
+    WORKER_ID: str = f'{socket.gethostname()}-{os.getpid()}'
+    LEASE_TTL: int = 300
+    LEASE_BATCH: int = 10
+
     class Config:
         case_sensitive = True
 
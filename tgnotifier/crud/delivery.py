@@ -0,0 +1,47 @@
+from tgnotifier.db.models import DeferredItem, moscowtz
+from datetime import datetime, timedelta
+
+IMMEDIATE = 'immediate'
+HOURLY = 'hourly'
+DAILY = 'daily'
+DELIVERY_MODES = (IMMEDIATE, HOURLY, DAILY)
+PERIODS = {HOURLY: timedelta(hours=1), DAILY: timedelta(days=1)}
+
+def parse_time(s):
+	"""
+	Time of a daily delivery, HH:MM. Raises ValueError if it isn't one.
+	"""
+	return datetime.strptime(s.strip(), '%H:%M').time()
+
+def local_now():
+	# delivery times are kept as Moscow time without a zone
+	return datetime.now(tz=moscowtz).replace(tzinfo=None)
+
+def window_start(client, now):
+	"""
+	Start of the client's latest delivery window that has opened by `now`.
+	"""
+	if client.delivery == HOURLY:
+		return now.replace(minute=0, second=0, microsecond=0)
+	start = datetime.combine(now.date(), parse_time(client.delivery_time or '00:00'))
+	return start if start <= now else start - PERIODS[DAILY]
+
+def describe_delivery(client):
+	if client.delivery == DAILY:
+		return f'daily at {client.delivery_time}'
+	return client.delivery
+
+def defer_items(clients, items):
+	rows = [(i.id, text, seen) for i in clients for text, seen in items]
+	if rows:
+		DeferredItem.insert_many(rows,
+			fields=[DeferredItem.client, DeferredItem.text, DeferredItem.seen]).execute()
+
+def take_deferred_items(client):
+	"""
+	Deletes the client's deferred items and returns them as (text, seen) pairs in order,
+	so a concurrent delivery doesn't get them again.
+	"""
+	rows = (DeferredItem.delete().where(DeferredItem.client==client.id)
+		.returning(DeferredItem.id, DeferredItem.text, DeferredItem.seen).tuples().execute())
+	return [(text, seen) for i, text, seen in sorted(rows)]
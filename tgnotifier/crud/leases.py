@@ -0,0 +1,66 @@
+from tgnotifier.db.models import Lease
+from tgnotifier.core.settings import settings
+from peewee import Value, fn
+from datetime import timedelta
+
+def sync_leases(model):
+	"""
+	Add leases of new sources, due at random times within INTERVAL so that they
+	don't all fire at once, and drop the ones of deleted sources.
+	"""
+	source = model._meta.table_name
+	(Lease
+		.insert_from(model.select(Value(source), model.id,
+				fn.now() + fn.random() * timedelta(seconds=settings.INTERVAL)).order_by(),
+			fields=[Lease.source, Lease.source_id, Lease.due_at])
+		.on_conflict_ignore()
+		.execute())
+	Lease.delete().where(Lease.source==source,
+		Lease.source_id.not_in(model.select(model.id).order_by())).execute()
+
+def claim_leases(model, limit):
+	"""
+	Lease up to `limit` due sources that aren't leased or whose lease expired,
+	skipping the ones other workers are claiming right now.
+	Returns ids of the leased sources.
+	"""
+	now = fn.now()
+	due = (Lease.select(Lease.id)
+		.where(Lease.source==model._meta.table_name, Lease.due_at <= now,
+			Lease.owner.is_null() | (Lease.expires_at < now))
+		.order_by(Lease.due_at)
+		.limit(limit)
+		.for_update('FOR UPDATE SKIP LOCKED'))
+	return [l.source_id for l in Lease
+		.update(owner=settings.WORKER_ID,
+			expires_at=now + timedelta(seconds=settings.LEASE_TTL))
+		.where(Lease.id.in_(due))
+		.returning(Lease.source_id)
+		.execute()]
+
+def release_leases(model, ids, delay=None):
+	"""
+	Release leases this worker still holds.
+	With `delay` the sources become due again in that many seconds, else they stay due.
+	"""
+	values = {Lease.owner: None, Lease.expires_at: None}
+	if delay is not None:
+		values[Lease.due_at] = fn.now() + timedelta(seconds=delay)
+	Lease.update(values).where(
+		Lease.source==model._meta.table_name,
+		Lease.source_id.in_(ids),
+		Lease.owner==settings.WORKER_ID).execute()
+
+def seconds_until_due(model):
+	"""
+	Time until the next source is due or a lease of a due one expires, None if there are no sources.
+	"""
+	now = fn.now().cast('timestamp')
+	due = fn.MIN(fn.GREATEST(Lease.due_at, fn.COALESCE(Lease.expires_at, Lease.due_at)))
+	nearest, current = (Lease.select(due, now)
+		.where(Lease.source==model._meta.table_name)
+		.order_by()
+		.scalar(as_tuple=True))
+	if nearest is None:
+		return None
+	return (nearest - current).total_seconds()
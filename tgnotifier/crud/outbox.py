@@ -0,0 +1,72 @@
+from tgnotifier.db.models import OutboxMessage
+from tgnotifier.core.settings import settings
+from peewee import fn, SQL
+from datetime import timedelta
+import json
+
+def enqueue_messages(messages):
+	"""
+	Writes (chat_id, text, description, options) to the outbox.
+	"""
+	rows = [(chat_id, text, description, json.dumps(options))
+		for chat_id, text, description, options in messages]
+	if rows:
+		(OutboxMessage
+			.insert_many(rows, fields=[OutboxMessage.chat_id, OutboxMessage.text,
+				OutboxMessage.description, OutboxMessage.options])
+			.execute())
+
+def claim_messages(limit):
+	"""
+	Lease up to `limit` due messages, skipping the ones other workers are claiming right now.
+	A message is only claimed when no earlier message of its chat is put off or leased,
+	so that a chat gets its messages in order.
+	Returns the messages ordered by id.
+	"""
+	now = fn.now()
+	Earlier = OutboxMessage.alias()
+	blocked = (Earlier.select(SQL('1'))
+		.where(Earlier.chat_id==OutboxMessage.chat_id, Earlier.id < OutboxMessage.id,
+			(Earlier.due_at > now) | (Earlier.owner.is_null(False) & (Earlier.expires_at >= now))))
+	due = (OutboxMessage.select(OutboxMessage.id)
+		.where(OutboxMessage.due_at <= now,
+			OutboxMessage.owner.is_null() | (OutboxMessage.expires_at < now),
+			~fn.EXISTS(blocked))
+		.order_by(OutboxMessage.id)
+		.limit(limit)
+		.for_update('FOR UPDATE SKIP LOCKED'))
+	return sorted(OutboxMessage
+		.update(owner=settings.WORKER_ID,
+			expires_at=now + timedelta(seconds=settings.OUTBOX_TTL))
+		.where(OutboxMessage.id.in_(due))
+		.returning(OutboxMessage)
+		.execute(), key=lambda m: m.id)
+
+def extend_messages(ids):
+	"""
+	Renew the leases of the messages this worker still holds.
+	"""
+	if ids:
+		OutboxMessage.update(expires_at=fn.now() + timedelta(seconds=settings.OUTBOX_TTL)).where(
+			OutboxMessage.id.in_(ids), OutboxMessage.owner==settings.WORKER_ID).execute()
+
+def delete_messages(ids):
+	if ids:
+		OutboxMessage.delete().where(OutboxMessage.id.in_(ids)).execute()
+
+def release_messages(ids, delay=None, failed=None):
+	"""
+	Give the messages back to the outbox, due in `delay` seconds.
+	The attempts of the message that `failed` are counted.
+	"""
+	if failed is not None:
+		OutboxMessage.update(attempts=OutboxMessage.attempts + 1).where(OutboxMessage.id==failed).execute()
+	values = {OutboxMessage.owner: None, OutboxMessage.expires_at: None}
+	if delay is not None:
+		values[OutboxMessage.due_at] = fn.now() + timedelta(seconds=delay)
+	if ids:
+		OutboxMessage.update(values).where(
+			OutboxMessage.id.in_(ids), OutboxMessage.owner==settings.WORKER_ID).execute()
+
+def retry_delay(attempts):
+	return settings.OUTBOX_RETRY_INTERVAL * 2 ** attempts
@@ -0,0 +1,71 @@
+from tgnotifier.db.models import db, TitleCache, SiteLastPost, moscowtz
+from tgnotifier.core.settings import settings
+from tgnotifier.utils.sites import get_title_by_url
+from peewee import Value
+from datetime import datetime, timedelta
+from html import escape
+import asyncio
+
+def post_item(site, post):
+	"""
+	Notification item of a new post.
+	"""
+	return (f"<a href='{escape(post.url, quote=True)}'>{escape(post.title or post.url)}</a>"
+		f"<b> - {escape(site.name)}</b>", f"SEEN;{post.id}")
+
+def get_cached_titles(urls):
+	if not urls:
+		return {}
+	now = datetime.now(tz=moscowtz)
+	titles = {c.url: c.title for c in TitleCache.select(TitleCache.url, TitleCache.title)
+		.where(TitleCache.url.in_(urls),
+			TitleCache.created_at > now - timedelta(seconds=settings.TITLE_CACHE_TTL))
+		.iterator()}
+	if titles:
+		TitleCache.update(used_at=now).where(TitleCache.url.in_(list(titles))).execute()
+	return titles
+
+def cache_titles(titles):
+	rows = [(u, t[:255]) for u, t in titles.items() if t]
+	if rows:
+		now = datetime.now(tz=moscowtz)
+		(TitleCache
+			.insert_many([(u, t, now, now) for u, t in rows],
+				fields=[TitleCache.url, TitleCache.title, TitleCache.created_at, TitleCache.used_at])
+			.on_conflict(conflict_target=[TitleCache.url],
+				preserve=[TitleCache.title, TitleCache.created_at, TitleCache.used_at])
+			.execute())
+
+def prune_title_cache():
+	"""
+	Drop expired titles, then the least recently used ones above TITLE_CACHE_SIZE.
+	"""
+	now = datetime.now(tz=moscowtz)
+	with db.atomic():
+		TitleCache.delete().where(
+			TitleCache.created_at <= now - timedelta(seconds=settings.TITLE_CACHE_TTL)).execute()
+		TitleCache.delete().where(TitleCache.id.in_(
+			TitleCache.select(TitleCache.id)
+			.order_by(TitleCache.used_at.desc())
+			.offset(settings.TITLE_CACHE_SIZE))).execute()
+
+def seed_title_cache():
+	if not TitleCache.select().exists():
+		now = datetime.now(tz=moscowtz)
+		(TitleCache
+			.insert_from(SiteLastPost.select(SiteLastPost.url, SiteLastPost.title, Value(now), Value(now))
+				.where(SiteLastPost.title.is_null(False)).order_by(),
+				fields=[TitleCache.url, TitleCache.title, TitleCache.created_at, TitleCache.used_at])
+			.on_conflict_ignore()
+			.execute())
+
+async def get_titles(urls):
+	"""
+	Titles of posts by their urls. Only the ones missing in cache are downloaded.
+	"""
+	titles = get_cached_titles(urls)
+	missing = [u for u in urls if u not in titles]
+	fetched = dict(zip(missing, await asyncio.gather(*[get_title_by_url(u) for u in missing])))
+	cache_titles(fetched)
+	titles.update(fetched)
+	return titles
@@ -0,0 +1,57 @@
+from tgnotifier.db.models import Client, Subscription
+from peewee import JOIN
+
+
+class Subscribers:
+	"""
+	Clients to notify about the sources of a model.
+	"""
+
+	def __init__(self, everything, by_source):
+		self.everything = everything
+		self.by_source = by_source
+
+	def of(self, source):
+		return self.everything + self.by_source.get(source.id, [])
+
+
+def subscribers(model):
+	"""
+	Resolves the subscribers of all the model's sources with one query.
+	Subscriptions of deleted sources are dropped first.
+	"""
+	source = model._meta.table_name
+	Subscription.delete().where(Subscription.source==source,
+		Subscription.source_id.not_in(model.select(model.id).order_by())).execute()
+	query = (Client
+		.select(Client.id, Client.name, Client.chat_id, Client.delivery, Client.all_sources,
+			Subscription.source_id)
+		.join(Subscription, JOIN.LEFT_OUTER, on=((Subscription.client==Client.id)
+			& (Subscription.source==source) & ~Client.all_sources))
+		.where(Client.chat_id!=None, Client.all_sources | Subscription.id.is_null(False))
+		.order_by()
+		.objects())
+	everything, by_source = [], {}
+	for c in query.iterator():
+		if c.all_sources:
+			everything.append(c)
+		else:
+			by_source.setdefault(c.source_id, []).append(c)
+	return Subscribers(everything, by_source)
+
+def subscribed_ids(client, model):
+	return {s.source_id for s in Subscription.select(Subscription.source_id)
+		.where(Subscription.client==client.id, Subscription.source==model._meta.table_name)}
+
+def toggle_subscription(client, model, source_id):
+	"""
+	Subscribes the client to the source or unsubscribes if it already is.
+	Returns whether the client is subscribed now.
+	"""
+	source = model._meta.table_name
+	deleted = Subscription.delete().where(Subscription.client==client.id,
+		Subscription.source==source, Subscription.source_id==source_id).execute()
+	if deleted:
+		return False
+	Subscription.insert(client=client.id, source=source, source_id=source_id).on_conflict_ignore().execute()
+	return True
@@ -0,0 +1,19 @@
+from playhouse.migrate import SchemaMigrator, migrate
+from .session import db
+
+def add_missing_columns(models):
+	"""
+	Add columns for fields that were added to models after their tables had been created.
+	Such fields must be nullable or have a default.
+	"""
+	migrator = SchemaMigrator.from_database(db)
+	operations = []
+	for model in models:
+		table = model._meta.table_name
+		columns = {c.name for c in db.get_columns(table)}
+		for field in model._meta.sorted_fields:
+			if field.column_name not in columns:
+				operations.append(migrator.add_column(table, field.column_name, field))
+	if operations:
+		with db.atomic():
+			migrate(*operations)
@@ -1,4 +1,4 @@
-from peewee import (Model, FloatField, CharField,
+from peewee import (Model, FloatField, CharField, SQL,
  ForeignKeyField, IntegerField, BooleanField, UUIDField, DateTimeField, TextField)
 from .session import db
 from passlib.hash import bcrypt
@@ -29,12 +29,46 @@ class BaseModel(Model):
 class Client(BaseModel):
 	name = CharField(unique=True)
 	chat_id = IntegerField(unique=True, null=True)
+	# 'immediate', 'hourly' or 'daily' at delivery_time (HH:MM, Moscow time)
+	delivery = CharField(default='immediate')
+	delivery_time = CharField(null=True)
+	delivered_at = DateTimeField(null=True)
+	# notified about every source, else only about the subscribed ones
+	all_sources = BooleanField(default=True)
 
 	class Meta:
 		db_table = "clients"
 		order_by = ['name']
 
 
+class DeferredItem(BaseModel):
+	"""
+	New item waiting for the delivery window of the client.
+	"""
+	client = ForeignKeyField(Client, backref="deferred", on_delete='CASCADE', on_update='CASCADE')
+	text = TextField()
+	seen = CharField()
+	created_at = DateTimeField(default=lambda: datetime.now(tz=moscowtz))
+
+	class Meta:
+		db_table = "deferreditems"
+
+
+class Subscription(BaseModel):
+	"""
+	Client's subscription to a source, `source` is the table of the source.
+	"""
+	client = ForeignKeyField(Client, backref="subscriptions", on_delete='CASCADE', on_update='CASCADE')
+	source = CharField()
+	source_id = IntegerField()
+
+	class Meta:
+		db_table = "subscriptions"
+		indexes = (
+			(("client", "source", "source_id"), True),
+		)
+
+
 class Term(BaseModel):
 	value = CharField(unique=True)
 
@@ -49,6 +83,8 @@ class Term(BaseModel):
 class SearchQuery(BaseModel):
 	name = CharField(unique=True)
 	value = CharField(unique=True)
+	poll_interval = IntegerField(null=True)
+	failures = IntegerField(default=0)
 
 	class Meta:
 		db_table = 'searchqueries'
@@ -85,6 +121,14 @@ class Site(BaseModel):
 	url = CharField(unique=True)
 	stack = TextField()
 	same_domain = BooleanField(default=True)
+	etag = CharField(null=True)
+	last_modified = CharField(null=True)
+	fingerprint = CharField(null=True)
+	engine = CharField(null=True)
+	poll_interval = IntegerField(null=True)
+	failures = IntegerField(default=0)
+	# set by a burst of new posts, which may mean the stack no longer fits the page
+	suspect_at = DateTimeField(null=True)
 
 	class Meta:
 		db_table = "sites"
@@ -111,6 +155,8 @@ class SiteUnseenPost(BaseModel):
 	url = CharField()
 	title = CharField(null=True)
 	current_timestamp = DateTimeField(index=True, default=lambda: datetime.now(tz=moscowtz))
+	# found in a burst and not sent till a client confirms it
+	held = BooleanField(default=False)
 
 	class Meta:
 		db_table = "siteunseenposts"
@@ -119,10 +165,22 @@ class SiteUnseenPost(BaseModel):
 		)
 		order_by = ['-current_timestamp']
 
+class TitleCache(BaseModel):
+	url = CharField(unique=True)
+	title = CharField()
+	created_at = DateTimeField(index=True, default=lambda: datetime.now(tz=moscowtz))
+	used_at = DateTimeField(index=True, default=lambda: datetime.now(tz=moscowtz))
+
+	class Meta:
+		db_table = "titlecache"
+
 class Channel(BaseModel):
 	name = CharField(unique=True)
 	link = CharField(unique=True)
 	list_id = CharField(unique=True)
+	poll_interval = IntegerField(null=True)
+	failures = IntegerField(default=0)
+
 	class Meta:
 		db_table = "channels"
 		order_by = ['name']
@@ -175,8 +233,48 @@ class UnseenVideo(BaseModel):
 		return self.value
 
 
-MODELS = (Client,
+class Lease(BaseModel):
+	"""
+	Claim of a source by one of the workers polling it.
+	`source` is the table of the source, times are of the database.
+	"""
+	source = CharField()
+	source_id = IntegerField()
+	owner = CharField(null=True)
+	expires_at = DateTimeField(null=True)
+	due_at = DateTimeField(index=True)
+
+	class Meta:
+		db_table = "leases"
+		indexes = (
+			(("source", "source_id"), True),
+		)
+
+
+class OutboxMessage(BaseModel):
+	"""
+	Notification waiting to be sent, written in the transaction that found its item.
+	`options` are the JSON keyword arguments of send_message. A message is leased
+	by the worker sending it, times are of the database.
+	"""
+	chat_id = IntegerField()
+	text = TextField()
+	options = TextField(default='{}')
+	description = CharField(default='message')
+	attempts = IntegerField(default=0)
+	due_at = DateTimeField(constraints=[SQL('DEFAULT now()')], index=True)
+	owner = CharField(null=True)
+	expires_at = DateTimeField(null=True)
+
+	class Meta:
+		db_table = "outbox"
+		indexes = (
+			(("chat_id", "id"), False),
+		)
+
+
+MODELS = (Client, DeferredItem, Subscription,
 		Term, LastVideo, UnseenVideo, Channel, ExcludeTerm, IncludeTerm, 
 		SearchQuery, QueryLastVideo, QueryUnseenVideo,
-		SiteLastPost, SiteUnseenPost, Site
+		SiteLastPost, SiteUnseenPost, Site, TitleCache, Lease, OutboxMessage
 	)
@@ -17,6 +17,12 @@ class PeeweeConnectionState(_ConnectionState):
     def __getattr__(self, name):
         return self._state.get()[name]
 
-db = connect(settings.DATABASE_URL)
+db = connect(settings.DATABASE_URL,
+    options=f'-c statement_timeout={settings.DB_STATEMENT_TIMEOUT * 1000}')
 
 db._state = PeeweeConnectionState()
+
+
+async def reset_db_state():
+    db._state._state.set(db_state_default.copy())
+    db._state.reset()
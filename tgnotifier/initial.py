@@ -1,5 +1,8 @@
-from .db.models import Client
+from .db.models import db, Client, MODELS
+from .db.migrate import add_missing_columns
 from .core.settings import settings
+from .crud.sites import seed_title_cache
+import traceback
 #from peewee import OperationalError
 
 def create_client():
@@ -7,4 +10,18 @@ def create_client():
 		Client.get_or_create(name=settings.FIRST_CLIENT)
 
 def initialize_db():
+	add_missing_columns(MODELS)
 	create_client()
+	seed_title_cache()
+
+def setup_db():
+	"""
+	Creates the tables and the initial data, on startup of the app or of the worker.
+	"""
+	db.connect()
+	try:
+		db.create_tables(MODELS)
+		initialize_db()
+	except Exception as e:
+		traceback.print_exc()
+	db.close()
@@ -3,24 +3,15 @@ from starlette.responses import Response
 from starlette.status import HTTP_200_OK
 from .core.settings import settings
 from .api.v1.api import api_router as api_v1
-from .db.session import db
-from .db.models import MODELS
-from .initial import initialize_db
+from .initial import setup_db
 from .utils.log import log
-from fastapi_utils.tasks import repeat_every
-from .tasks.youtube import getVideosFromChannelsJob, getVideosByQueryJob
-from .tasks.sites import getNewPostsJob
-import traceback
+from .utils.http import close_session
+from .utils.concurrency import shutdown_executor
+import asyncio
 #from peewee import OperationalError
 #from psycopg2 import errors
 
-db.connect()
-try:
-	db.create_tables(MODELS)
-	initialize_db()
-except Exception as e:
-	traceback.print_exc()
-db.close()
+setup_db()
 
 app = FastAPI(
 	title=settings.PROJECT_NAME,
@@ -29,13 +20,35 @@ app = FastAPI(
 
 app.include_router(api_v1, prefix=settings.API_V1_STR)
 
+app.on_event("shutdown")(close_session)
+app.on_event("shutdown")(shutdown_executor)
+
 @app.get('/')
 async def get_root():
 	return Response(status_code=HTTP_200_OK)
 
 if settings.RUN_TASKS:
+	from .tasks import JOBS
+	from .tasks.scheduler import Scheduler
 	log("Running tasks",error=False)
-	app.on_event("startup")(repeat_every(seconds=settings.INTERVAL)(getNewPostsJob))
-	app.on_event("startup")(repeat_every(seconds=settings.INTERVAL)(getVideosFromChannelsJob))
-	app.on_event("startup")(repeat_every(seconds=settings.INTERVAL)(getVideosByQueryJob))
+
+	@app.on_event("startup")
+	async def start_scheduler():
+		app.state.scheduler = asyncio.create_task(Scheduler(JOBS).run())
+
+	@app.on_event("shutdown")
+	async def stop_scheduler():
+		app.state.scheduler.cancel()
+
+if settings.RUN_SENDER:
+	from .tasks.outbox import drainOutbox
+
+	@app.on_event("startup")
+	async def start_sender():
+		app.state.sender = asyncio.create_task(drainOutbox())
+
+	@app.on_event("shutdown")
+	async def stop_sender():
+		app.state.sender.cancel()
+		await asyncio.gather(app.state.sender, return_exceptions=True)
 
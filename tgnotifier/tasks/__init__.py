@@ -0,0 +1,5 @@
+from .sites import getNewPostsJob
+from .youtube import getVideosFromChannelsJob, getVideosByQueryJob
+from .delivery import deliverDeferredJob
+
+JOBS = (getNewPostsJob, getVideosFromChannelsJob, getVideosByQueryJob, deliverDeferredJob)
@@ -1,12 +1,15 @@
-from tgnotifier.api.v1.deps import reset_db_state
-from tgnotifier.db.session import db
-from tgnotifier.db.models import Client
+from tgnotifier.db.session import db, reset_db_state
+from tgnotifier.crud.leases import sync_leases, claim_leases, release_leases
+from tgnotifier.crud.subscriptions import subscribers
+from tgnotifier.core.settings import settings
 from tgnotifier.utils.log import log
-from tgnotifier.telegram.dispatcher import dispatcher
-import time
+from tgnotifier.utils.concurrency import time_left
+from functools import wraps
+import asyncio
 import traceback
 
 def with_db(f):
+	@wraps(f)
 	async def wrapper(*args, **kwargs):
 		await reset_db_state()
 		try:
@@ -17,13 +20,20 @@ def with_db(f):
 				db.close()
 	return wrapper
 
-def with_clients(f):
-	async def wrapper(*args, **kwargs):
-		kwargs['clients']=Client.select(Client.name, Client.chat_id).where(Client.chat_id!=None)
-		return await f(*args, **kwargs)
-	return wrapper
+def with_clients(model):
+	"""
+	Passes the subscribers of the model's sources to the job, resolved once per run.
+	"""
+	def decorator(f):
+		@wraps(f)
+		async def wrapper(*args, **kwargs):
+			kwargs['clients']=subscribers(model)
+			return await f(*args, **kwargs)
+		return wrapper
+	return decorator
 
 def with_default_exception_handler(f):
+	@wraps(f)
 	async def wrapper(*args, **kwargs):
 		try:
 			return await f(*args, **kwargs)
@@ -32,16 +42,45 @@ def with_default_exception_handler(f):
 			traceback.print_exc()
 	return wrapper
 
-async def send_messages_to_client_list(messages, clients, mes_type='message', parse_mode='HTML'):
-	for m in messages:
-		for i in clients:
-			for j in range(3):
-				try:
-					await dispatcher.bot.send_message(i.chat_id, 
-										m[0], 
-										parse_mode=parse_mode,
-										reply_markup=m[1])
-					break
-				except Exception as e:
-					log(f"Failed to send {mes_type} to {i.name}: {m[1]}:\n{e}")
-					time.sleep(2)
\ No newline at end of file
+def claim_sources(model, count):
+	ids = claim_leases(model, count)
+	return list(model.select().where(model.id.in_(ids))) if ids else []
+
+async def poll_leased(model, poll, limit):
+	"""
+	Polls the due sources leased by this worker with `poll(source)`, so that several workers
+	poll every source once. Up to `limit` polls run at once and new leases are claimed
+	as soon as a poll ends, at most LEASE_BATCH at a time, so a slow source holds up only its own slot.
+	A lease is released when its poll ends, a polled source is rescheduled by then,
+	so that only matters for the polls that didn't finish. No leases are taken after
+	the deadline of the run. Returns the results of the polls.
+	"""
+	sync_leases(model)
+	results = []
+	running = set()
+
+	async def run(source):
+		try:
+			results.append(await poll(source))
+		finally:
+			release_leases(model, [source.id])
+
+	try:
+		while True:
+			left = time_left()
+			if left is not None and left <= 0:
+				log(f"{model.__name__} polling stopped at the deadline, the rest is left for the next run.")
+				break
+			for source in claim_sources(model, min(limit - len(running), settings.LEASE_BATCH)):
+				running.add(asyncio.create_task(run(source)))
+			if not running:
+				break
+			done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+	except asyncio.CancelledError:
+		for task in running:
+			task.cancel()
+		raise
+	finally:
+		if running:
+			await asyncio.wait(running)
+	return results
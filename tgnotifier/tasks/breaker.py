@@ -0,0 +1,84 @@
+"""
+Circuit breaker of the polled sources.
+A failed or timed out poll is retried after an exponential backoff. After BREAKER_THRESHOLD failures
+in a row the source is open: it's only probed once per backoff, with a single attempt,
+until a probe succeeds. The admin is notified when a source opens and when it recovers.
+"""
+from tgnotifier.core.settings import settings
+from tgnotifier.db.models import Client
+from tgnotifier.crud.leases import release_leases
+from tgnotifier.telegram.sender import sender
+from tgnotifier.utils.log import log
+from tgnotifier.utils.concurrency import run_with_budget
+from .scheduler import reschedule, jittered
+import asyncio
+import traceback
+
+def is_open(source):
+	return source.failures >= settings.BREAKER_THRESHOLD
+
+def attempts(source):
+	"""
+	Attempts of a poll, None for the default ones.
+	"""
+	return 1 if is_open(source) else None
+
+def backoff(failures):
+	return min(settings.BREAKER_BACKOFF * 2 ** (failures - 1), settings.BREAKER_MAX_BACKOFF)
+
+def describe(source):
+	return f'{type(source).__name__} "{source.name}"'
+
+async def notify_admin(text):
+	if settings.ADMIN_CHAT_ID:
+		chat_ids = [settings.ADMIN_CHAT_ID]
+	else:
+		chat_ids = [c.chat_id for c in Client.select(Client.chat_id)
+			.where(Client.name==settings.FIRST_CLIENT, Client.chat_id!=None)]
+	for chat_id in chat_ids:
+		sender.send(chat_id, text, "notice to the admin")
+
+async def polled(source, found):
+	"""
+	Close the source's breaker after a successful poll and reschedule the source.
+	"""
+	if source.failures:
+		recovered = is_open(source)
+		model = type(source)
+		model.update(failures=0).where(model.id==source.id).execute()
+		source.failures = 0
+		if recovered:
+			await notify_admin(f"{describe(source)} is available again.")
+	reschedule(source, found)
+
+async def failed(source, error):
+	"""
+	Count the failure and put off the next poll of the source.
+	"""
+	log(f"{describe(source)}: {error}")
+	traceback.print_exception(type(error), error, error.__traceback__)
+	model = type(source)
+	source.failures += 1
+	model.update(failures=source.failures).where(model.id==source.id).execute()
+	delay = backoff(source.failures)
+	release_leases(model, [source.id], jittered(delay))
+	if source.failures == settings.BREAKER_THRESHOLD:
+		await notify_admin(f"{describe(source)} failed {source.failures} times in a row, "
+			f"the next attempt is in about {round(delay / 60)} minutes.\n{error}")
+
+async def poll(source, coro):
+	"""
+	Awaits the source's poll, which returns the number of new items or None if nothing changed,
+	within SOURCE_TIMEOUT and records its result.
+	Returns the result of the poll, False if it failed.
+	"""
+	try:
+		found = await run_with_budget(coro, settings.SOURCE_TIMEOUT)
+	except asyncio.TimeoutError:
+		await failed(source, asyncio.TimeoutError("The poll timed out and was cancelled."))
+		return False
+	except Exception as e:
+		await failed(source, e)
+		return False
+	await polled(source, found or 0)
+	return found
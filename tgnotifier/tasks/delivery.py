@@ -0,0 +1,33 @@
+from tgnotifier.utils.log import log
+from tgnotifier.core.settings import settings
+from tgnotifier.db.models import Client, DeferredItem, moscowtz
+from tgnotifier.crud.delivery import IMMEDIATE, PERIODS, local_now, window_start
+from tgnotifier.telegram.notify import deliver
+from .base import with_db, with_default_exception_handler
+from datetime import timedelta
+
+@with_default_exception_handler
+@with_db
+async def deliverDeferredJob():
+	"""
+	Delivers deferred items of the clients whose window has opened, and the ones
+	left from before a client switched to immediate delivery or by a cycle that didn't end.
+	Returns the time till the next window.
+	"""
+	now = local_now()
+	delays = [settings.INTERVAL]
+	stale = now - timedelta(seconds=settings.JOB_DEADLINE + settings.SOURCE_TIMEOUT)
+	clients = Client.select().where(Client.chat_id!=None,
+		(Client.delivery!=IMMEDIATE) | Client.id.in_(DeferredItem.select(DeferredItem.client)
+			.where(DeferredItem.created_at < moscowtz.localize(stale))))
+	for client in clients.iterator():
+		if client.delivery == IMMEDIATE:
+			deliver(client, now)
+			continue
+		start = window_start(client, now)
+		if client.delivered_at is None or client.delivered_at < start:
+			count = deliver(client, now)
+			if count:
+				log(f"Delivered {count} deferred items to {client.name}.", error=False)
+		delays.append((start + PERIODS[client.delivery] - now).total_seconds())
+	return max(min(delays), 1)
@@ -0,0 +1,73 @@
+"""
+Sending of the outbox.
+Due messages are claimed in batches with SKIP LOCKED and passed to the sender, so any
+number of senders can run next to the pollers. Sent messages are deleted in bulk,
+the ones the sender gave up on are put back with a backoff. Messages claimed by
+a sender that died are sent again once their claim expires: a message is sent
+at least once.
+"""
+from tgnotifier.core.settings import settings
+from tgnotifier.crud.outbox import (
+	claim_messages, extend_messages, delete_messages, release_messages, retry_delay
+)
+from tgnotifier.telegram.sender import sender, Message
+from tgnotifier.utils.log import log
+from .base import with_db, with_default_exception_handler
+import json
+import time
+
+def settle():
+	"""
+	Record what the sender has done in the outbox.
+	"""
+	done = list(sender.done)
+	delete_messages([m.id for m in done])
+	del sender.done[:len(done)]
+	while sender.failed:
+		failed, *rest = sender.failed[0]
+		if failed.retries + 1 >= settings.OUTBOX_ATTEMPTS:
+			log(f"Failed to send {failed.description}, dropped after {failed.retries + 1} tries.")
+			delete_messages([failed.id])
+			release_messages([m.id for m in rest])
+		else:
+			release_messages([failed.id] + [m.id for m in rest],
+				retry_delay(failed.retries), failed=failed.id)
+		sender.failed.pop(0)
+
+@with_default_exception_handler
+@with_db
+async def drain(extend=False):
+	settle()
+	if extend:
+		extend_messages([m.id for m in sender.queued()])
+	free = settings.OUTBOX_BATCH - sender.pending()
+	if free > 0:
+		for m in claim_messages(free):
+			sender.put(m.chat_id, Message(m.id, m.text, json.loads(m.options), m.description, m.attempts))
+
+@with_default_exception_handler
+@with_db
+async def release():
+	"""
+	Give the messages that weren't sent back to the outbox at once.
+	"""
+	settle()
+	release_messages([m.id for m in sender.queued()])
+	sender.chats.clear()
+
+async def drainOutbox():
+	"""
+	Sends the messages of the outbox till cancelled.
+	"""
+	sender.start()
+	extended = time.monotonic()
+	try:
+		while True:
+			extend = time.monotonic() - extended > settings.OUTBOX_TTL / 3
+			await drain(extend)
+			if extend:
+				extended = time.monotonic()
+			await sender.wait(settings.OUTBOX_POLL_INTERVAL)
+	finally:
+		await sender.stop(settings.SEND_STOP_TIMEOUT)
+		await release()
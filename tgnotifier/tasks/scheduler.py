@@ -0,0 +1,95 @@
+from tgnotifier.core.settings import settings
+from tgnotifier.crud.leases import release_leases, seconds_until_due
+from tgnotifier.utils.concurrency import budget
+from tgnotifier.utils.log import log
+from heapq import heappush, heappop
+from itertools import count
+import asyncio
+import random
+
+def next_interval(interval, found):
+	"""
+	Polling interval of a source after a poll that found `found` new items:
+	halved if there were any, else longer by POLL_BACKOFF, within the POLL_*_INTERVAL bounds.
+	"""
+	interval = interval or settings.INTERVAL
+	interval = interval / 2 if found else interval * settings.POLL_BACKOFF
+	return int(min(max(interval, settings.POLL_MIN_INTERVAL), settings.POLL_MAX_INTERVAL))
+
+def jittered(seconds):
+	return seconds * random.uniform(1 - settings.POLL_JITTER, 1 + settings.POLL_JITTER)
+
+def reschedule(source, found):
+	"""
+	Adapt the source's interval to the poll's result and release its lease till the next poll.
+	"""
+	model = type(source)
+	interval = next_interval(source.poll_interval, found)
+	if interval != source.poll_interval:
+		model.update(poll_interval=interval).where(model.id==source.id).execute()
+	release_leases(model, [source.id], jittered(interval))
+
+def next_run(model):
+	"""
+	Seconds until a job polling the model's sources has to run again.
+	Not longer than INTERVAL, so that new sources are picked up.
+	"""
+	delay = seconds_until_due(model)
+	if delay is None:
+		return settings.INTERVAL
+	return min(max(delay, 1), settings.INTERVAL)
+
+
+class Scheduler:
+	"""
+	Runs jobs at their due times, kept in a priority queue.
+	A job returns the number of seconds till its next run, INTERVAL is used if it returns None.
+	Must be created inside the running event loop.
+	"""
+
+	def __init__(self, jobs):
+		self.queue = []
+		self.order = count()
+		self.running = set()
+		self.wakeup = asyncio.Event()
+		for job in jobs:
+			self.add(job, 0)
+
+	def add(self, job, delay):
+		heappush(self.queue, (asyncio.get_running_loop().time() + delay, next(self.order), job))
+		self.wakeup.set()
+
+	async def run_job(self, job):
+		delay = None
+		try:
+			with budget(settings.JOB_DEADLINE):
+				# the job stops by itself at the deadline, this is the last resort
+				delay = await asyncio.wait_for(job(), settings.JOB_DEADLINE + settings.SOURCE_TIMEOUT)
+		except asyncio.TimeoutError:
+			log(f"{job.__name__} was cancelled after running past its deadline.")
+		finally:
+			self.add(job, settings.INTERVAL if delay is None else delay)
+
+	def start(self, job):
+		task = asyncio.create_task(self.run_job(job))
+		self.running.add(task)
+		task.add_done_callback(self.running.discard)
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		try:
+			while True:
+				self.wakeup.clear()
+				timeout = None
+				if self.queue:
+					timeout = self.queue[0][0] - loop.time()
+					if timeout <= 0:
+						self.start(heappop(self.queue)[2])
+						continue
+				try:
+					await asyncio.wait_for(self.wakeup.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+		finally:
+			for task in list(self.running):
+				task.cancel()
@@ -1,46 +1,104 @@
 from tgnotifier.utils.log import log
-from .base import (
-	with_db, with_default_exception_handler, with_clients, 
-	send_messages_to_client_list
-)
-from aiogram.types.inline_keyboard import InlineKeyboardButton, InlineKeyboardMarkup
+from .base import with_db, with_default_exception_handler, with_clients, poll_leased
+from tgnotifier.telegram.notify import with_digest, send_messages_to_client_list
+from tgnotifier.core.settings import settings
 from tgnotifier.db.models import (
-	db, Site, SiteLastPost, SiteUnseenPost,
+	db, Site, SiteLastPost, SiteUnseenPost, moscowtz
 )
 from tgnotifier.utils.sites import (
-	get_posts_by_stacks, get_title_by_url, clear_ads, filter_new_posts
+	fetch_page, get_validators, get_fingerprint, get_posts_by_stacks, clear_ads, filter_new_posts,
+	is_burst
 	)
+from tgnotifier.crud.sites import get_titles, prune_title_cache, post_item
+from tgnotifier.telegram.sender import sender
+from tgnotifier.telegram.digest import flood_keyboard
+from .scheduler import next_run
+from .breaker import attempts, poll
+from tgnotifier.utils.concurrency import HostLimiter
+from datetime import datetime
+from html import escape
+
+async def get_site_posts(st, html):
+	"""
+	Returns urls of posts on the site's page and titles found right on it.
+	"""
+	titles = dict(await get_posts_by_stacks(st.url, st.stack, html, st.engine))
+	new_posts = list(titles)
+	if st.same_domain:
+		new_posts = clear_ads(st.url, new_posts)
+	return (new_posts, titles)
+
+async def process_site(st, clients, limiter):
+	"""
+	Returns the number of new posts, None if the site's page is the same
+	as on the previous check and was skipped.
+	"""
+	last_posts = {x.url: x.title for x in SiteLastPost.select(SiteLastPost.url, SiteLastPost.title).where(SiteLastPost.site==st).objects().iterator()}
+	async with limiter.acquire(st.url):
+		res = await fetch_page(st.url, st.etag, st.last_modified, attempts(st))
+		if res.status == 304:
+			return None
+		html = res.text()
+		etag, last_modified = get_validators(res)
+		fingerprint = get_fingerprint(st.stack, html)
+		if fingerprint == st.fingerprint:
+			if (etag, last_modified) != (st.etag, st.last_modified):
+				Site.update(etag=etag, last_modified=last_modified).where(Site.id==st.id).execute()
+			return None
+		new_posts, titles = await get_site_posts(st, html)
+		titles.update(await get_titles([p for p in new_posts if p not in last_posts and not titles[p]]))
+	titles.update({p: t for p, t in last_posts.items() if t})
+	# titles learned from the page can be any length, the columns hold 255
+	titles = {p: t[:255] if t else t for p, t in titles.items()}
+	ft = bool(last_posts)
+	messages = []
+	new_posts, page_posts = filter_new_posts(last_posts, [(p, titles.get(p)) for p in new_posts])
+	burst = is_burst(last_posts, page_posts, new_posts)
+	last_posts = page_posts
+	with db.atomic() as trans:
+		Site.update(etag=etag, last_modified=last_modified,
+			fingerprint=fingerprint).where(Site.id==st.id).execute()
+		last_posts.reverse()
+		SiteLastPost.delete().where(SiteLastPost.site==st.id).execute()
+		SiteLastPost.insert_many([(st.id, p[0], p[1]) for p in last_posts],fields=[SiteLastPost.site, SiteLastPost.url, SiteLastPost.title]).execute()
+		if ft:
+			new_posts.reverse()
+			for p in new_posts:
+				up, created = SiteUnseenPost.get_or_create(site=st.id, url=p[0], title=p[1],
+					defaults={'held': burst})
+				if created:
+					messages.append(post_item(st, up))
+		if messages and burst:
+			hold_burst(st, len(messages), len(last_posts), clients)
+			return 0
+		if messages:
+			send_messages_to_client_list(messages, clients, f'[{st.name}] post')
+	return len(messages)
+
+def hold_burst(st, count, total, clients):
+	"""
+	Records a possible breakage of the site's stack and asks its clients
+	whether to send the held posts, in a single message.
+	"""
+	log(f"Site {st.name}: {count} of {total} posts on the page are new, "
+		"they are held as the stack may no longer fit the page.")
+	Site.update(suspect_at=datetime.now(tz=moscowtz)).where(Site.id==st.id).execute()
+	text = (f"<b>{escape(st.name)}</b>: {count} of {total} posts on the page are new at once. "
+		"The site may have changed its layout, the posts are held. Send them?")
+	sender.send_all([(i.chat_id, text, f"[{st.name}] burst notice to {i.name}",
+			{'parse_mode': 'HTML', 'reply_markup': flood_keyboard(st.id)})
+		for i in clients])
 
 @with_default_exception_handler
 @with_db
-@with_clients
+@with_clients(Site)
+@with_digest
 async def getNewPostsJob(clients):
 	log("Retreiving new Posts.", error=False)
-	for st in Site.select().iterator():
-		new_posts = get_posts_by_stacks(st.url, st.stack)
-		if st.same_domain:
-			new_posts = clear_ads(st.url, new_posts)
-		new_posts = [(p, get_title_by_url(p)) for p in new_posts]
-		last_posts = [x.url for x in SiteLastPost.select(SiteLastPost.url).where(SiteLastPost.site==st).objects().iterator()]
-		ft = bool(last_posts)
-		messages = []
-		new_posts, last_posts = filter_new_posts(last_posts, new_posts)
-		with db.atomic() as trans:
-			last_posts.reverse()
-			SiteLastPost.delete().where(SiteLastPost.site==st.id).execute()
-			SiteLastPost.insert_many([(st.id, p[0], p[1]) for p in last_posts],fields=[SiteLastPost.site, SiteLastPost.url, SiteLastPost.title]).execute()
-			if ft:
-				new_posts.reverse()
-				for p in new_posts:
-					up, created = SiteUnseenPost.get_or_create(site=st.id, url=p[0], title=p[1])
-					if created:
-						keyboard=InlineKeyboardMarkup(2)
-						keyboard.add(InlineKeyboardButton('Seen', 
-											callback_data=f"SEEN;{up.id}"),
-							InlineKeyboardButton('x', callback_data="R"))
-						messages.append((f"<a href='{p[0]}'>{p[1]}</a><b> - {st.name}</b>",
-							keyboard))
-		if messages:
-			await send_messages_to_client_list(messages, list(clients), f'[{st.name}] post')
-
-    
\ No newline at end of file
+	limiter = HostLimiter(settings.SITES_CONCURRENCY, settings.SITES_HOST_CONCURRENCY)
+	results = await poll_leased(Site,
+		lambda st: poll(st, process_site(st, clients.of(st), limiter)), settings.SITES_CONCURRENCY)
+	unchanged = sum(1 for res in results if res is None)
+	log(f"Sites unchanged since the last check: {unchanged} of {len(results)}.", error=False)
+	prune_title_cache()
+	return next_run(Site)
@@ -5,76 +5,86 @@ from tgnotifier.db.models import (
 	SearchQuery, QueryLastVideo, QueryUnseenVideo, moscowtz
 )
 from datetime import datetime
+from html import escape
+import asyncio
 from tgnotifier.utils.youtube import getNewVideosFromPlaylist, getNewVideosFromSearchQuery
-from .base import (
-	with_db, with_default_exception_handler, with_clients, send_messages_to_client_list
-)
-from aiogram.types.inline_keyboard import InlineKeyboardButton, InlineKeyboardMarkup
+from .base import with_db, with_default_exception_handler, with_clients, poll_leased
+from tgnotifier.telegram.notify import with_digest, send_messages_to_client_list
+from .scheduler import next_run
+from .breaker import attempts, poll
+
+async def process_channel(ch, clients):
+	"""
+	Returns the number of new videos of the channel.
+	"""
+	lastvideos = [i.value for i in LastVideo.select(LastVideo.value).where(LastVideo.channel==ch).iterator()]
+	l = bool(lastvideos)
+	incterms = [i.value for i in IncludeTerm.select(Term.value).join(Term).where(IncludeTerm.channel==ch).objects().iterator()]
+	exterms = [i.value for i in ExcludeTerm.select(Term.value).join(Term).where(ExcludeTerm.channel==ch).objects().iterator()]
+	# the API client blocks, in a thread the poll's budget still applies and the loop stays free
+	lastvideos, videos = await asyncio.to_thread(getNewVideosFromPlaylist,
+		ch.list_id, lastvideos, incterms, exterms, attempts(ch))
+	messages = []
+	with db.atomic() as trans:
+		LastVideo.delete().where(LastVideo.channel==ch.id).execute()
+		LastVideo.insert_many([(ch.id, v) for v in lastvideos],fields=[LastVideo.channel, LastVideo.value]).execute()
+		if l:
+			for v in videos:
+				uv, created = UnseenVideo.get_or_create(value=v[1], channel=ch.id)
+				if created:
+					messages.append((f"<b>[{escape(ch.name)}] </b><a href='https://youtube.com/watch?v={escape(v[1], quote=True)}'>{escape(v[0])}</a>",
+						f"YSEEN;{uv.id}"))
+		if messages:
+			send_messages_to_client_list(messages, clients, f'[{ch.name}] channel video')
+	return len(messages)
 
 @with_default_exception_handler
 @with_db
-@with_clients
+@with_clients(Channel)
+@with_digest
 async def getVideosFromChannelsJob(clients):
 	log("Catching new videos from channels.", error=False)
-	for ch in Channel.select().iterator():
-		lastvideos = [i.value for i in LastVideo.select(LastVideo.value).where(LastVideo.channel==ch).iterator()]
-		l = bool(lastvideos)
-		incterms = [i.value for i in IncludeTerm.select(Term.value).join(Term).where(IncludeTerm.channel==ch).objects().iterator()]
-		exterms = [i.value for i in ExcludeTerm.select(Term.value).join(Term).where(ExcludeTerm.channel==ch).objects().iterator()]
-		lastvideos, videos = getNewVideosFromPlaylist(ch.list_id, lastvideos, incterms, exterms)
-		messages = []
-		with db.atomic() as trans:
-			LastVideo.delete().where(LastVideo.channel==ch.id).execute()
-			LastVideo.insert_many([(ch.id, v) for v in lastvideos],fields=[LastVideo.channel, LastVideo.value]).execute()
-			if l:
-				for v in videos:
-					uv, created = UnseenVideo.get_or_create(value=v[1], channel=ch.id)
-					if created:
-						keyboard=InlineKeyboardMarkup(2)
-						keyboard.add(InlineKeyboardButton('Seen', 
-											callback_data=f"YSEEN;{uv.id}"),
-							InlineKeyboardButton('x', callback_data="R"))
-						messages.append((f"<b>[{ch.name}] </b><a href='https://youtube.com/watch?v={v[1]}'>{v[0]}</a>",
-							keyboard))
-		videos = messages
-		if videos:
-			await send_messages_to_client_list(videos, list(clients), f'[{ch.name}] channel video')
+	await poll_leased(Channel, lambda ch: poll(ch, process_channel(ch, clients.of(ch))), 1)
+	return next_run(Channel)
+
 
+async def process_query(q, clients):
+	"""
+	Returns the number of new videos found by the query.
+	"""
+	lastvideos = [i.value for i in QueryLastVideo.select(QueryLastVideo.value)
+			.where(QueryLastVideo.query==q)
+			.order_by(QueryLastVideo.current_timestamp.desc()).iterator()]
+	l = bool(lastvideos)
+	lastvideos, videos = await getNewVideosFromSearchQuery(q.value,lastvideos, attempts(q))
+	messages = []
+	with db.atomic() as trans:
+		lastvideos.reverse()
+		for v in lastvideos:
+			lv, created = QueryLastVideo.get_or_create(query=q.id, value=v)
+			if not created:
+				lv.current_timestamp=datetime.now(tz=moscowtz)
+				lv.save()
+		if l:
+			videos.reverse()
+			for v in videos:
+				uv, created = QueryUnseenVideo.get_or_create(value=v[0], query=q.id)
+				if created:
+					messages.append((f"<b>({escape(q.name)}) </b><a href='https://youtube.com/watch?v={escape(v[0], quote=True)}'>{escape(v[1])}</a>",
+						f"QSEEN;{uv.id}"))
+		QueryLastVideo.delete().where(QueryLastVideo.id.in_(
+			QueryLastVideo.select(QueryLastVideo.id).where(QueryLastVideo.query==q.id)
+			.order_by(QueryLastVideo.current_timestamp.desc()).offset(20)
+		))
+		if messages:
+			send_messages_to_client_list(messages, clients, f'({q.name}) query video')
+	return len(messages)
 
 @with_default_exception_handler
 @with_db
-@with_clients
+@with_clients(SearchQuery)
+@with_digest
 async def getVideosByQueryJob(clients):
 	log("Catching new videos from queries.", error=False)
-	for q in SearchQuery.select().iterator():
-		lastvideos = [i.value for i in QueryLastVideo.select(QueryLastVideo.value)
-				.where(QueryLastVideo.query==q)
-				.order_by(QueryLastVideo.current_timestamp.desc()).iterator()]
-		l = bool(lastvideos)
-		lastvideos, videos = getNewVideosFromSearchQuery(q.value,lastvideos)
-		messages = []
-		with db.atomic() as trans:
-			lastvideos.reverse()
-			for v in lastvideos:
-				lv, created = QueryLastVideo.get_or_create(query=q.id, value=v)
-				if not created:
-					lv.current_timestamp=datetime.now(tz=moscowtz)
-					lv.save()
-			if l:
-				videos.reverse()
-				for v in videos:
-					uv, created = QueryUnseenVideo.get_or_create(value=v[0], query=q.id)
-					if created:
-						keyboard=InlineKeyboardMarkup(2)
-						keyboard.add(InlineKeyboardButton('Seen', 
-											callback_data=f"QSEEN;{uv.id}"),
-							InlineKeyboardButton('x', callback_data="R"))
-						messages.append((f"<b>({q.name}) </b><a href='https://youtube.com/watch?v={v[0]}'>{v[1]}</a>",
-							keyboard))
-			QueryLastVideo.delete().where(QueryLastVideo.id.in_(
-				QueryLastVideo.select(QueryLastVideo.id).where(QueryLastVideo.query==q.id)
-				.order_by(QueryLastVideo.current_timestamp.desc()).offset(20)
-			))
-		videos = messages
-		if videos:
-			await send_messages_to_client_list(videos, list(clients), f'({q.name}) query video')
\ No newline at end of file
+	await poll_leased(SearchQuery, lambda q: poll(q, process_query(q, clients.of(q))), 1)
+	return next_run(SearchQuery)
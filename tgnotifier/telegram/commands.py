@@ -25,6 +25,8 @@ commands_dict = {
 	'qlast': "Last youtube-query videos",
 	'qunseen': "Unseen youtube-query videos",
 	'clear_unseen_q_videos': "Clear all unseen query videos",
+	'delivery': 'Delivery of notifications',
+	'subscriptions': 'Sources to be notified about',
 	'add_client': "Add client",
 	'remove_client': 'Remove client'
 }
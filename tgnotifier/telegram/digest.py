@@ -0,0 +1,75 @@
+"""
+Notifications about new items.
+An item is its HTML text and the callback data of its "Seen" button.
+Without digests every item is a message of its own. A digest packs items into
+numbered lines of as few messages as Telegram's limits allow, with a "Seen"
+button per number and one for all of them.
+"""
+from aiogram.types.inline_keyboard import InlineKeyboardButton, InlineKeyboardMarkup
+
+MESSAGE_LIMIT = 4096
+# Telegram allows 100 buttons, the rest are for the last row
+MAX_ITEMS = 96
+ROW_WIDTH = 8
+DIGEST_PREFIX = 'D'
+ALL_SEEN = 'DALL'
+FLOOD_PREFIX = 'FLD'
+
+def item_keyboard(seen):
+	keyboard = InlineKeyboardMarkup(2)
+	keyboard.add(InlineKeyboardButton('Seen', callback_data=seen),
+		InlineKeyboardButton('x', callback_data="R"))
+	return keyboard
+
+def digest_keyboard(seens):
+	keyboard = InlineKeyboardMarkup(ROW_WIDTH)
+	keyboard.add(*[InlineKeyboardButton(f'✓{n}', callback_data=f'{DIGEST_PREFIX}{seen}')
+		for n, seen in enumerate(seens, 1)])
+	keyboard.row(InlineKeyboardButton('All seen', callback_data=ALL_SEEN),
+		InlineKeyboardButton('x', callback_data="R"))
+	return keyboard
+
+def flood_keyboard(site_id):
+	keyboard = InlineKeyboardMarkup(3)
+	keyboard.add(InlineKeyboardButton('Send', callback_data=f'{FLOOD_PREFIX}{site_id};1'),
+		InlineKeyboardButton('Discard', callback_data=f'{FLOOD_PREFIX}{site_id};0'),
+		InlineKeyboardButton('x', callback_data="R"))
+	return keyboard
+
+def pack(items):
+	"""
+	Returns digests of the items, (text, keyboard) pairs. Lengths are counted with the
+	markup, so a digest is never longer than the limit. An item too long for a digest
+	gets a message of its own.
+	"""
+	digests = []
+	lines, seens, size = [], [], 0
+	for text, seen in items:
+		line = f'{len(lines) + 1}. {text}'
+		if lines and (size + 1 + len(line) > MESSAGE_LIMIT or len(lines) == MAX_ITEMS):
+			digests.append(('\n'.join(lines), digest_keyboard(seens)))
+			lines, seens, size = [], [], 0
+			line = f'1. {text}'
+		if len(line) > MESSAGE_LIMIT:
+			digests.append((text, item_keyboard(seen)))
+			continue
+		size += len(line) + bool(lines)
+		lines.append(line)
+		seens.append(seen)
+	if lines:
+		digests.append(('\n'.join(lines), digest_keyboard(seens)))
+	return digests
+
+def digest_seens(keyboard):
+	"""
+	Callback data of the items still unseen in the digest's keyboard.
+	"""
+	return [b.callback_data[len(DIGEST_PREFIX):] for row in keyboard.inline_keyboard for b in row
+		if b.callback_data.startswith(DIGEST_PREFIX) and b.callback_data != ALL_SEEN]
+
+def without_button(keyboard, data):
+	"""
+	Digest keyboard without the button of an item marked seen.
+	"""
+	rows = [[b for b in row if b.callback_data != data] for row in keyboard.inline_keyboard]
+	return InlineKeyboardMarkup(ROW_WIDTH, inline_keyboard=[row for row in rows if row])
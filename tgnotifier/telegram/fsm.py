@@ -22,12 +22,19 @@ from tgnotifier.crud.youtube import (
 from tgnotifier.crud.base import select_with_count_of_backref
 from tgnotifier.utils.log import log
 from tgnotifier.utils.sites import (
-	is_valid_url, make_stacks_by_posts, get_title_by_url, clear_ads
+	is_valid_url, make_stacks_by_posts, clear_ads
 	)
+from tgnotifier.crud.sites import get_titles, post_item
+from tgnotifier.crud.subscriptions import subscribers, subscribed_ids, toggle_subscription
+from .notify import send_messages_to_client_list
+from tgnotifier.crud.delivery import (
+	DAILY, DELIVERY_MODES, parse_time, describe_delivery
+)
 import re
 import urllib.parse
 from peewee import JOIN, IntegrityError
 from .commands import commands_dict
+from .digest import DIGEST_PREFIX, ALL_SEEN, FLOOD_PREFIX, digest_seens, without_button
 
 def with_client_check(f):
 	async def wrapper(message: types.Message):
@@ -224,6 +231,125 @@ async def help_command(message: types.Message) -> None:
     	reply_markup=types.inline_keyboard.InlineKeyboardMarkup(1, [[
     		types.inline_keyboard.InlineKeyboardButton('x', callback_data='R')]]))
 
+# Delivery
+
+def delivery_markup():
+	return types.inline_keyboard.InlineKeyboardMarkup(3, [[
+		types.inline_keyboard.InlineKeyboardButton(mode.capitalize(), callback_data=f'DLV;{mode}')
+		for mode in DELIVERY_MODES]])
+
+@dispatcher.message_handler(commands=['delivery'])
+@with_client_check_and_get
+async def delivery_command(message: types.Message, user) -> None:
+	await dispatcher.bot.send_message(message.chat.id,
+		f'Delivery: {describe_delivery(user)}.\n'
+		'Hourly and daily deliveries send the new items collected since the last one as digests.',
+		reply_markup=delivery_markup())
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(r'^DLV;\w+$',callback_query.data), state='*')
+async def set_delivery(callback_query: types.callback_query.CallbackQuery, state: FSMContext) -> None:
+	mode = callback_query.data.split(";")[1]
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+	user = Client.get_or_none(name=callback_query.message.chat.username)
+	if not user or mode not in DELIVERY_MODES:
+		return
+	if mode == DAILY:
+		await state.set_state('setting_delivery_time')
+		await dispatcher.bot.send_message(callback_query.message.chat.id,
+			'Input the time of the daily delivery, HH:MM (Moscow time):')
+		return
+	Client.update(delivery=mode).where(Client.id==user.id).execute()
+	await dispatcher.bot.edit_message_text(f'Delivery: {mode}.',
+		callback_query.message.chat.id, callback_query.message.message_id)
+
+@dispatcher.message_handler(state='setting_delivery_time')
+async def set_delivery_time(message: types.Message, state: FSMContext) -> None:
+	try:
+		time = parse_time(message.text).strftime('%H:%M')
+	except ValueError:
+		await dispatcher.bot.send_message(message.chat.id, 'Wrong time, input HH:MM:')
+		return
+	try:
+		Client.update(delivery=DAILY, delivery_time=time).where(
+			Client.name==message.chat.username).execute()
+		await dispatcher.bot.send_message(message.chat.id, f'Delivery: daily at {time}.')
+	except Exception as e:
+		await dispatcher.bot.send_message(message.chat.id, str(e))
+	finally:
+		await state.finish()
+
+# Subscriptions
+
+SUBSCRIPTION_MENUS = {'SUBS': (Site, 'Sites'), 'SUBC': (Channel, 'Channels'), 'SUBQ': (SearchQuery, 'Youtube queries')}
+
+def subscriptions_markup(user):
+	return types.inline_keyboard.InlineKeyboardMarkup(3, [
+		[types.inline_keyboard.InlineKeyboardButton(title, callback_data=call_name)
+			for call_name, (model, title) in SUBSCRIPTION_MENUS.items()],
+		[types.inline_keyboard.InlineKeyboardButton(
+			'Only subscriptions' if user.all_sources else 'All sources', callback_data='SUBALL'),
+		types.inline_keyboard.InlineKeyboardButton('x', callback_data='R')]])
+
+def subscriptions_text(user):
+	if user.all_sources:
+		return 'Notifications: all sources.\nSubscriptions are used after switching to "Only subscriptions".'
+	return 'Notifications: only subscribed sources.\nChoose the sources to subscribe or unsubscribe.'
+
+async def post_subscriptions_menu(chat, user, call_name, page, message=None):
+	model, title = SUBSCRIPTION_MENUS[call_name]
+	subscribed = subscribed_ids(user, model)
+	await post_items_menu_paged(chat, model.select(model.id, model.name), f'{title} (✓ - subscribed)',
+		call_name, page, to_str=lambda o: f"{'✓ ' if o.id in subscribed else ''}{o.name}",
+		with_page=True, message=message)
+
+@dispatcher.message_handler(commands=['subscriptions'])
+@with_client_check_and_get
+async def subscriptions_command(message: types.Message, user) -> None:
+	await dispatcher.bot.send_message(message.chat.id, subscriptions_text(user),
+		reply_markup=subscriptions_markup(user))
+
+@dispatcher.callback_query_handler(lambda callback_query: callback_query.data=='SUBALL', state='*')
+async def toggle_all_sources(callback_query: types.callback_query.CallbackQuery) -> None:
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+	user = Client.get_or_none(name=callback_query.message.chat.username)
+	if user:
+		user.all_sources = not user.all_sources
+		Client.update(all_sources=user.all_sources).where(Client.id==user.id).execute()
+		await dispatcher.bot.edit_message_text(subscriptions_text(user),
+			callback_query.message.chat.id, callback_query.message.message_id,
+			reply_markup=subscriptions_markup(user))
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(r'^SUB[SCQ]$',callback_query.data), state='*')
+async def get_sources_list_for_subscription(callback_query: types.callback_query.CallbackQuery) -> None:
+	user = Client.get_or_none(name=callback_query.message.chat.username)
+	if user:
+		await post_subscriptions_menu(callback_query.message.chat.id, user, callback_query.data, 1)
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(r'^SUB[SCQ],\d+$',callback_query.data), state='*')
+async def get_sources_list_for_subscription_by_page(callback_query: types.callback_query.CallbackQuery) -> None:
+	call_name, page = callback_query.data.split(",")
+	page = int(page)
+	user = Client.get_or_none(name=callback_query.message.chat.username)
+	if user and page > 0:
+		await post_subscriptions_menu(callback_query.message.chat.id, user, call_name, page,
+			message=callback_query.message.message_id)
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(r'^SUB[SCQ],\d+;\d+$',callback_query.data), state='*')
+async def toggle_source_subscription(callback_query: types.callback_query.CallbackQuery) -> None:
+	pid, sid = callback_query.data.split(";")
+	call_name, pid = pid.split(",")
+	user = Client.get_or_none(name=callback_query.message.chat.username)
+	if user:
+		try:
+			toggle_subscription(user, SUBSCRIPTION_MENUS[call_name][0], int(sid))
+			await post_subscriptions_menu(callback_query.message.chat.id, user, call_name, int(pid),
+				message=callback_query.message.message_id)
+		except Exception as e:
+			await dispatcher.bot.send_message(callback_query.message.chat.id, str(e))
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+
 # Channels
 
 #Last videos
@@ -693,7 +819,8 @@ async def get_sites_list_for_unseen_by_page(callback_query: types.callback_query
 async def get_unseenposts_of_site(callback_query: types.callback_query.CallbackQuery) -> None:
 	sid = int(callback_query.data.split(";")[1])
 	await dispatcher.bot.answer_callback_query(callback_query.id)
-	for s in SiteUnseenPost.select(SiteUnseenPost.id, SiteUnseenPost.url, SiteUnseenPost.title).where(SiteUnseenPost.site==sid).order_by(SiteUnseenPost.id.asc()).iterator():
+	for s in (SiteUnseenPost.select(SiteUnseenPost.id, SiteUnseenPost.url, SiteUnseenPost.title)
+			.where(SiteUnseenPost.site==sid, SiteUnseenPost.held==False).order_by(SiteUnseenPost.id.asc()).iterator()):
 		keyboard=types.inline_keyboard.InlineKeyboardMarkup(2)
 		keyboard.add(types.inline_keyboard.InlineKeyboardButton('Seen', 
 											callback_data=f"SEEN;{s.id}"),
@@ -710,19 +837,79 @@ async def remove_seen_post(callback_query: types.callback_query.CallbackQuery) -
 		callback_query.message.message_id)
 	await dispatcher.bot.answer_callback_query(callback_query.id)
 
+SEEN_MODELS = {'SEEN': SiteUnseenPost, 'YSEEN': UnseenVideo, 'QSEEN': QueryUnseenVideo}
+
+def mark_seen(data):
+	kind, ident = data.split(";")
+	model = SEEN_MODELS[kind]
+	model.delete().where(model.id==ident).execute()
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(r'^D[YQ]?SEEN;',callback_query.data), state='*')
+async def remove_seen_digest_item(callback_query: types.callback_query.CallbackQuery) -> None:
+	mark_seen(callback_query.data[len(DIGEST_PREFIX):])
+	keyboard = without_button(callback_query.message.reply_markup, callback_query.data)
+	if digest_seens(keyboard):
+		await dispatcher.bot.edit_message_reply_markup(callback_query.message.chat.id,
+			callback_query.message.message_id, reply_markup=keyboard)
+	else:
+		await dispatcher.bot.delete_message(callback_query.message.chat.id,
+			callback_query.message.message_id)
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+
+@dispatcher.callback_query_handler(lambda callback_query: callback_query.data==ALL_SEEN, state='*')
+async def remove_seen_digest(callback_query: types.callback_query.CallbackQuery) -> None:
+	with db.atomic():
+		for data in digest_seens(callback_query.message.reply_markup):
+			mark_seen(data)
+	await dispatcher.bot.delete_message(callback_query.message.chat.id,
+		callback_query.message.message_id)
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+
+@dispatcher.callback_query_handler(lambda callback_query: re.match(rf'^{FLOOD_PREFIX}\d+;[01]$',callback_query.data), state='*')
+async def confirm_held_posts(callback_query: types.callback_query.CallbackQuery) -> None:
+	sid, send = callback_query.data[len(FLOOD_PREFIX):].split(";")
+	await dispatcher.bot.answer_callback_query(callback_query.id)
+	site = Site.get_or_none(id=int(sid))
+	held = []
+	if site:
+		# the rows are claimed by the statement itself, so concurrent clicks never share them
+		with db.atomic():
+			query = SiteUnseenPost.update(held=False) if send == '1' else SiteUnseenPost.delete()
+			held = sorted(query
+				.where(SiteUnseenPost.site==site.id, SiteUnseenPost.held==True)
+				.returning(SiteUnseenPost.id, SiteUnseenPost.url, SiteUnseenPost.title,
+					SiteUnseenPost.current_timestamp)
+				.execute(), key=lambda p: p.current_timestamp)
+			if held and send == '1':
+				Site.update(suspect_at=None).where(Site.id==site.id).execute()
+				send_messages_to_client_list([post_item(site, p) for p in held],
+					subscribers(Site).of(site), f'[{site.name}] post')
+	if not held:
+		text = 'No held posts, another client has already decided.'
+	elif send == '1':
+		text = f'{len(held)} held posts of {site.name} are sent.'
+	else:
+		text = f'{len(held)} held posts of {site.name} are discarded. Check its parser with /last.'
+	await dispatcher.bot.edit_message_text(text,
+		callback_query.message.chat.id, callback_query.message.message_id)
+
+def site_to_str(o):
+	mark = ' ⚠ possibly broken parser' if o.suspect_at else ''
+	return f'<a href="{o.url}">{o.name}</a>{mark}'
+
 @dispatcher.message_handler(commands=['sites'])
 @with_client_check
 async def get_sites_list(message: types.Message) -> None:
-	await post_items_list_paged(message.chat.id, Site.select(Site.id, Site.name, Site.url), 
-		'Sites', 'SL', 1, to_str=lambda o: f'<a href="{o.url}">{o.name}</a>',
+	await post_items_list_paged(message.chat.id, Site.select(Site.id, Site.name, Site.url, Site.suspect_at), 
+		'Sites', 'SL', 1, to_str=site_to_str,
 		parse_mode='HTML')
 
 @dispatcher.callback_query_handler(lambda callback_query: re.match(r'^SL,\d+$',callback_query.data), state='*')
 async def get_sites_list_by_page(callback_query: types.callback_query.CallbackQuery) -> None:
 	page = int(callback_query.data.split(",")[1])
 	if page > 0:
-		await post_items_list_paged(callback_query.message.chat.id, Site.select(Site.id, Site.name, Site.url), 
-		'Sites', 'SL', page, to_str=lambda o: f'<a href="{o.url}">{o.name}</a>',
+		await post_items_list_paged(callback_query.message.chat.id, Site.select(Site.id, Site.name, Site.url, Site.suspect_at), 
+		'Sites', 'SL', page, to_str=site_to_str,
 		parse_mode='HTML',
 		message=callback_query.message.message_id)
 	await dispatcher.bot.answer_callback_query(callback_query.id)
@@ -781,14 +968,16 @@ async def set_site_same_domain(callback_query: types.callback_query.CallbackQuer
 			)
 		await state.update_data(same_domain=True)
 		s = (await state.get_data())
-		results, scraper = make_stacks_by_posts(s['url'], s['posts'])
+		results, scraper = await make_stacks_by_posts(s['url'], s['posts'], await get_titles(s['posts']))
 		if not results:
 			await state.finish()
 			await dispatcher.bot.send_message(callback_query.message.chat.id, 
 				"Error. Results not found.")
 		else:
-			results = clear_ads(s['url'], results)
-			results = [(p, get_title_by_url(p)) for p in results]
+			titles = dict(results)
+			results = clear_ads(s['url'], list(titles))
+			titles.update(await get_titles([p for p in results if not titles[p]]))
+			results = [(p, titles[p]) for p in results]
 			await state.update_data(stacks=scraper.dumpToStr(), posts=results)
 			await dispatcher.bot.send_message(callback_query.message.chat.id, 
 			'Here your results. Choose "Yes" to add this parser or "No" to cancel operation.\n\n' + 
@@ -811,13 +1000,15 @@ async def set_site_not_same_domain(callback_query: types.callback_query.Callback
 			)
 		await state.update_data(same_domain=False)
 		s = (await state.get_data())
-		results, scraper = make_stacks_by_posts(s['url'], s['posts'])
+		results, scraper = await make_stacks_by_posts(s['url'], s['posts'], await get_titles(s['posts']))
 		if not results:
 			await state.finish()
 			await dispatcher.bot.send_message(callback_query.message.chat.id, 
 				"Error. Results not found.")
 		else:
-			results = [(p, get_title_by_url(p)) for p in results]
+			titles = dict(results)
+			titles.update(await get_titles([p for p, t in results if not t]))
+			results = list(titles.items())
 			await state.update_data(stacks=scraper.dumpToStr(), posts=results)
 			await dispatcher.bot.send_message(callback_query.message.chat.id, 
 			'Here your results. Choose "Yes" to add this parser or "No" to cancel operation.\n\n' + 
@@ -898,7 +1089,7 @@ async def site_input_name_handler(message: types.Message, state: FSMContext) ->
 			s = Site.create(url=st['url'], stack=st['stacks'], 
 				name=name, same_domain=st['same_domain'])
 			st['posts'].reverse()
-			SiteLastPost.insert_many([(s.id, p[0], p[1]) for p in st['posts']],fields=[SiteLastPost.site, SiteLastPost.url, SiteLastPost.title]).execute()
+			SiteLastPost.insert_many([(s.id, p[0], p[1] and p[1][:255]) for p in st['posts']],fields=[SiteLastPost.site, SiteLastPost.url, SiteLastPost.title]).execute()
 			await state.finish()
 			await dispatcher.bot.send_message(message.chat.id, 
 					f'Parser for site <a href="{s.url}">{s.name}</a> added.',
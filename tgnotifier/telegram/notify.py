@@ -0,0 +1,65 @@
+"""
+New items to the outbox, for the jobs and for the handlers alike.
+"""
+from tgnotifier.db.session import db
+from tgnotifier.db.models import Client
+from tgnotifier.crud.delivery import IMMEDIATE, defer_items, take_deferred_items, local_now
+from tgnotifier.core.settings import settings
+from contextvars import ContextVar
+from functools import wraps
+from .sender import sender
+from .digest import pack, item_keyboard
+
+pending_items = ContextVar('pending_items', default=None)
+
+def deliver(client, now, description='deferred digest'):
+	"""
+	Sends the client's deferred items as digests.
+	"""
+	with db.atomic():
+		items = take_deferred_items(client)
+		Client.update(delivered_at=now).where(Client.id==client.id).execute()
+		sender.send_all([(client.chat_id, m[0], f"{description} to {client.name}",
+			{'parse_mode': 'HTML', 'reply_markup': m[1]}) for m in pack(items)])
+	return len(items)
+
+def with_digest(f):
+	"""
+	In the 'cycle' digest mode the job's items are kept like the deferred ones,
+	and sent as digests when it ends.
+	"""
+	@wraps(f)
+	async def wrapper(*args, **kwargs):
+		if settings.DIGEST != 'cycle':
+			return await f(*args, **kwargs)
+		clients = {}
+		token = pending_items.set(clients)
+		try:
+			return await f(*args, **kwargs)
+		finally:
+			pending_items.reset(token)
+			now = local_now()
+			for client in clients.values():
+				deliver(client, now, 'digest')
+	return wrapper
+
+def send_messages_to_client_list(items, clients, mes_type='message', parse_mode='HTML'):
+	"""
+	Write the items for every client to the outbox, in the transaction that found them.
+	Items of the clients with a delivery window are kept till it opens.
+	Items are (text, callback data of the "Seen" button) pairs.
+	"""
+	pending = pending_items.get()
+	if pending is not None:
+		pending.update((i.id, i) for i in clients if i.delivery == IMMEDIATE)
+		defer_items(clients, items)
+		return
+	defer_items([i for i in clients if i.delivery != IMMEDIATE], items)
+	clients = [i for i in clients if i.delivery == IMMEDIATE]
+	if settings.DIGEST:
+		messages = pack(items)
+	else:
+		messages = [(text, item_keyboard(seen)) for text, seen in items]
+	sender.send_all([(i.chat_id, m[0], f"{mes_type} to {i.name}",
+			{'parse_mode': parse_mode, 'reply_markup': m[1]})
+		for m in messages for i in clients])
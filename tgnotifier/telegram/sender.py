@@ -0,0 +1,196 @@
+"""
+Outgoing notifications.
+Messages are written to the outbox table in the transaction that produced them,
+and a sender loads them from there (tasks/outbox.py). Loaded messages are queued
+per chat and sent by a few workers, within Telegram's limits: token buckets for
+the bot as a whole and for every chat. A chat's messages go one at a time and in order.
+RetryAfter pauses the chat for the given time, other transient errors are retried
+with backoff, none of that blocks the event loop.
+"""
+from aiogram.utils.exceptions import RetryAfter, BadRequest, Unauthorized
+from tgnotifier.core.settings import settings
+from tgnotifier.utils.log import log
+from tgnotifier.utils.http import backoff
+from tgnotifier.crud.outbox import enqueue_messages
+from collections import deque
+from .bot import bot
+import asyncio
+import time
+
+
+class TokenBucket:
+
+	def __init__(self, rate, capacity):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = time.monotonic()
+
+	def reserve(self):
+		"""
+		Takes a token, returns the number of seconds till it's actually available.
+		"""
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - 1
+		self.updated = now
+		return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+	async def acquire(self):
+		delay = self.reserve()
+		if delay:
+			await asyncio.sleep(delay)
+
+
+class Message:
+	"""
+	`retries` is the number of times the message was put back to the outbox.
+	"""
+
+	__slots__ = ('id', 'text', 'kwargs', 'description', 'attempts', 'retries')
+
+	def __init__(self, id, text, kwargs, description, retries=0):
+		self.id = id
+		self.text = text
+		self.kwargs = kwargs
+		self.description = description
+		self.attempts = 0
+		self.retries = retries
+
+
+class Sender:
+	"""
+	`chats` holds the queues of the chats with unsent messages, `ready` the chats
+	whose next message can be sent. A chat is in `ready` at most once, so its
+	messages are never sent concurrently.
+	`done` collects the messages sent or dropped, `failed` the queues of the chats
+	given up after SEND_ATTEMPTS, starting with the message that failed.
+	"""
+
+	def __init__(self, bot, workers, rate, chat_rate):
+		self.bot = bot
+		self.workers = workers
+		self.chat_rate = chat_rate
+		self.bucket = TokenBucket(rate, rate)
+		self.chat_buckets = {}
+		self.chats = {}
+		self.ready = None
+		self.wakeup = None
+		self.tasks = []
+		self.done = []
+		self.failed = []
+
+	def start(self):
+		if not self.tasks:
+			self.ready = asyncio.Queue()
+			self.wakeup = asyncio.Event()
+			for chat_id in self.chats:
+				self.ready.put_nowait(chat_id)
+			self.tasks = [asyncio.create_task(self.work()) for i in range(self.workers)]
+
+	def send(self, chat_id, text, description='message', **kwargs):
+		"""
+		Write a message to the outbox, the keyword arguments are passed to send_message.
+		"""
+		self.send_all([(chat_id, text, description, kwargs)])
+
+	def send_all(self, messages):
+		"""
+		Write (chat_id, text, description, kwargs) messages to the outbox. Needs the database,
+		the messages are sent once the calling transaction commits.
+		"""
+		enqueue_messages([(chat_id, text, description,
+				{k: v.to_python() if hasattr(v, 'to_python') else v for k, v in kwargs.items()})
+			for chat_id, text, description, kwargs in messages])
+		if self.wakeup:
+			self.wakeup.set()
+
+	def put(self, chat_id, message):
+		"""
+		Queue a message loaded from the outbox.
+		"""
+		self.start()
+		queue = self.chats.get(chat_id)
+		if queue is None:
+			queue = self.chats[chat_id] = deque()
+			self.ready.put_nowait(chat_id)
+		queue.append(message)
+
+	def pending(self):
+		return sum(len(q) for q in self.chats.values())
+
+	def queued(self):
+		return [m for q in self.chats.values() for m in q]
+
+	async def wait(self, timeout):
+		"""
+		Wait up to `timeout` seconds for new messages in the outbox.
+		"""
+		try:
+			await asyncio.wait_for(self.wakeup.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+		self.wakeup.clear()
+
+	def chat_bucket(self, chat_id):
+		bucket = self.chat_buckets.get(chat_id)
+		if bucket is None:
+			bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+		return bucket
+
+	async def deliver(self, chat_id, message):
+		"""
+		Returns the number of seconds to wait before trying the message again,
+		None if it was sent or dropped.
+		"""
+		try:
+			await self.bot.send_message(chat_id, message.text, **message.kwargs)
+			return None
+		except RetryAfter as e:
+			log(f"Sending {message.description} is put off for {e.timeout} s by Telegram.")
+			return e.timeout
+		except (BadRequest, Unauthorized) as e:
+			log(f"Failed to send {message.description}, dropped: {e}")
+			return None
+		except Exception as e:
+			message.attempts += 1
+			log(f"Failed to send {message.description}: {e}")
+			return backoff(message.attempts - 1, settings.SEND_INTERVAL)
+
+	async def work(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			chat_id = await self.ready.get()
+			queue = self.chats[chat_id]
+			await self.chat_bucket(chat_id).acquire()
+			await self.bucket.acquire()
+			delay = await self.deliver(chat_id, queue[0])
+			if delay is not None and queue[0].attempts >= settings.SEND_ATTEMPTS:
+				# the outbox retries it later, with the rest of the chat's messages
+				self.failed.append(list(queue))
+				del self.chats[chat_id]
+				continue
+			if delay is not None:
+				loop.call_later(delay, self.ready.put_nowait, chat_id)
+				continue
+			self.done.append(queue.popleft())
+			if queue:
+				self.ready.put_nowait(chat_id)
+			else:
+				del self.chats[chat_id]
+
+	async def stop(self, timeout):
+		"""
+		Wait up to `timeout` seconds for the queued messages to be sent, then stop the workers.
+		"""
+		for i in range(int(timeout * 10)):
+			if not self.chats:
+				break
+			await asyncio.sleep(0.1)
+		if self.chats:
+			log(f"{self.pending()} queued messages weren't sent, they stay in the outbox.")
+		for task in self.tasks:
+			task.cancel()
+		self.tasks = []
+
+
+sender = Sender(bot, settings.SEND_WORKERS, settings.TELEGRAM_RATE, settings.TELEGRAM_CHAT_RATE)
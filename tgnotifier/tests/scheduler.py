@@ -0,0 +1,165 @@
+import pytest
+import asyncio
+import heapq
+from tgnotifier.core.settings import settings
+from tgnotifier.tasks.scheduler import Scheduler, next_interval
+from tgnotifier.tasks.breaker import backoff
+from tgnotifier.utils.concurrency import budget, time_left, run_with_budget
+from tgnotifier.crud.delivery import window_start, parse_time
+from tgnotifier.db.models import Client, Site
+from tgnotifier.tasks import base
+from datetime import datetime
+
+class TestNextInterval:
+
+    def test_adapts(self):
+        assert next_interval(None, 0) == settings.INTERVAL * settings.POLL_BACKOFF
+        assert next_interval(None, 3) == settings.INTERVAL / 2
+
+    def test_bounds(self):
+        assert next_interval(settings.POLL_MIN_INTERVAL, 1) == settings.POLL_MIN_INTERVAL
+        assert next_interval(settings.POLL_MAX_INTERVAL, 0) == settings.POLL_MAX_INTERVAL
+
+
+class TestBackoff:
+
+    def test_doubles(self):
+        assert [backoff(n) for n in (1, 2, 3)] == [settings.BREAKER_BACKOFF * k for k in (1, 2, 4)]
+
+    def test_bounded(self):
+        assert backoff(100) == settings.BREAKER_MAX_BACKOFF
+
+
+class TestDeliveryWindow:
+
+    def test_hourly(self):
+        client = Client(delivery='hourly')
+        assert window_start(client, datetime(2021, 5, 1, 10, 42)) == datetime(2021, 5, 1, 10)
+
+    def test_daily(self):
+        client = Client(delivery='daily', delivery_time='09:30')
+        assert window_start(client, datetime(2021, 5, 1, 10)) == datetime(2021, 5, 1, 9, 30)
+        assert window_start(client, datetime(2021, 5, 1, 9)) == datetime(2021, 4, 30, 9, 30)
+
+    def test_parse_time(self):
+        assert parse_time(' 7:05 ').strftime('%H:%M') == '07:05'
+        with pytest.raises(ValueError):
+            parse_time('25:00')
+
+
+class TestScheduler:
+
+    def test_due_order(self, monkeypatch):
+        clock = [0]
+        runs = []
+
+        def job(name, delay):
+            async def run():
+                runs.append((clock[0], name))
+                return delay
+            return run
+
+        async def main():
+            monkeypatch.setattr(asyncio.get_running_loop(), 'time', lambda: clock[0])
+            scheduler = Scheduler([job('slow', 5), job('fast', 1)])
+            for i in range(8):
+                # what run() does once the earliest job is due, without waiting for it
+                clock[0], order, job_ = heapq.heappop(scheduler.queue)
+                await scheduler.run_job(job_)
+
+        asyncio.run(main())
+        assert runs == [(0, 'slow'), (0, 'fast'), (1, 'fast'), (2, 'fast'), (3, 'fast'), (4, 'fast'),
+            (5, 'slow'), (5, 'fast')]
+
+    def test_default_delay(self, monkeypatch):
+        async def job():
+            return None
+
+        async def main():
+            monkeypatch.setattr(asyncio.get_running_loop(), 'time', lambda: 10)
+            scheduler = Scheduler([])
+            await scheduler.run_job(job)
+            return scheduler.queue[0][0]
+
+        assert asyncio.run(main()) == 10 + settings.INTERVAL
+
+
+class TestPollLeased:
+
+    def run(self, monkeypatch, sources, poll, limit):
+        due = list(sources)
+        claims, released = [], []
+        monkeypatch.setattr(base, 'sync_leases', lambda model: None)
+        monkeypatch.setattr(base, 'release_leases', lambda model, ids: released.extend(ids))
+
+        def claim_sources(model, count):
+            claims.append(count)
+            claimed, due[:count] = due[:count], []
+            return claimed
+        monkeypatch.setattr(base, 'claim_sources', claim_sources)
+        results = asyncio.run(asyncio.wait_for(base.poll_leased(Site, poll, limit), 1))
+        return results, claims, released
+
+    def test_no_barrier(self, monkeypatch):
+        sources = [Site(id=i) for i in range(8)]
+        fast_done = asyncio.Event()
+        polled = []
+
+        async def poll(source):
+            if source.id == 0:
+                # ends only after all the others, which must not wait for it
+                await fast_done.wait()
+            polled.append(source.id)
+            if len(polled) == 7:
+                fast_done.set()
+            return source.id
+
+        results, claims, released = self.run(monkeypatch, sources, poll, 2)
+        assert polled == list(range(1, 8)) + [0]
+        assert sorted(results) == list(range(8))
+        assert sorted(released) == list(range(8))
+        assert claims[0] == 2 and max(claims) <= 2 and len(claims) > 4
+
+    def test_limit(self, monkeypatch):
+        running = []
+        peak = []
+
+        async def poll(source):
+            running.append(source.id)
+            peak.append(len(running))
+            await asyncio.sleep(0)
+            running.remove(source.id)
+
+        self.run(monkeypatch, [Site(id=i) for i in range(20)], poll, 3)
+        assert max(peak) == 3
+
+
+class TestBudget:
+
+    def test_earlier_deadline_wins(self):
+        async def main():
+            assert time_left() is None
+            with budget(1):
+                with budget(10) as seconds:
+                    assert seconds <= 1
+                    assert time_left() <= 1
+                assert time_left() <= 1
+            assert time_left() is None
+        asyncio.run(main())
+
+    def test_cancelled(self):
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def main():
+            with pytest.raises(asyncio.TimeoutError):
+                await run_with_budget(slow(), 0.01)
+            assert await run_with_budget(asyncio.sleep(0, 'done'), 1) == 'done'
+        asyncio.run(main())
+        assert cancelled
@@ -0,0 +1,199 @@
+import pytest
+import asyncio
+from aiogram.utils.exceptions import RetryAfter, ChatNotFound
+from tgnotifier.core.settings import settings
+from types import SimpleNamespace
+from tgnotifier.telegram.sender import Sender, TokenBucket, Message
+from tgnotifier.telegram import sender as sender_module
+from tgnotifier.telegram.digest import pack, digest_seens, without_button, MESSAGE_LIMIT
+from tgnotifier.crud.subscriptions import Subscribers
+from tgnotifier.db.models import Client, Site, SiteUnseenPost
+from tgnotifier.crud.sites import post_item
+from tgnotifier.crud.outbox import retry_delay
+from tgnotifier.tasks import outbox
+from xml.etree import ElementTree
+
+class FakeBot:
+
+    def __init__(self, failures=None, broken=()):
+        self.sent = []
+        self.failures = failures or {}
+        self.broken = broken
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+        failure = self.failures.pop((chat_id, text), None)
+        if failure:
+            raise failure
+        if (chat_id, text) in self.broken:
+            raise ConnectionError('Connection reset')
+        self.sent.append((chat_id, text))
+
+
+class TestTokenBucket:
+
+    def test_rate(self):
+        bucket = TokenBucket(100, 10)
+        delays = [bucket.reserve() for i in range(20)]
+        assert delays[:10] == [0] * 10
+        assert delays[-1] == pytest.approx(0.1, abs=0.01)
+
+
+class TestSender:
+
+    def run(self, bot, messages, rate=1000, chat_rate=1000):
+        async def main():
+            sender = Sender(bot, 4, rate, chat_rate)
+            for i, (chat_id, text) in enumerate(messages):
+                sender.put(chat_id, Message(i, text, {}, 'message'))
+            await sender.stop(2)
+            return sender
+        return asyncio.run(main())
+
+    def test_order_per_chat(self):
+        bot = FakeBot({(1, 'a1'): RetryAfter(0.05), (2, 'b0'): ChatNotFound('Chat not found')})
+        messages = [(c, f'{n}{i}') for i in range(3) for c, n in ((1, 'a'), (2, 'b'), (3, 'c'))]
+        sender = self.run(bot, messages)
+        assert not sender.chats
+        assert [t for c, t in bot.sent if c == 1] == ['a0', 'a1', 'a2']
+        assert [t for c, t in bot.sent if c == 2] == ['b1', 'b2']
+        assert [t for c, t in bot.sent if c == 3] == ['c0', 'c1', 'c2']
+        assert sorted(m.id for m in sender.done) == list(range(9))
+
+    def test_zero_delay(self, monkeypatch):
+        monkeypatch.setattr(settings, 'SEND_INTERVAL', 0)
+        bot = FakeBot({(1, 'a0'): RetryAfter(0)}, broken={(2, 'b0')})
+        sender = self.run(bot, [(1, 'a0'), (2, 'b0')])
+        assert bot.sent == [(1, 'a0')]
+        assert [m.text for m in sender.done] == ['a0']
+        assert [[m.text for m in q] for q in sender.failed] == [['b0']]
+
+    def test_gives_up(self, monkeypatch):
+        monkeypatch.setattr(settings, 'SEND_INTERVAL', 0.01)
+        bot = FakeBot(broken={(1, 'a1')})
+        sender = self.run(bot, [(1, 'a0'), (1, 'a1'), (1, 'a2'), (2, 'b0')])
+        assert sorted(bot.sent) == [(1, 'a0'), (2, 'b0')]
+        assert [[m.text for m in q] for q in sender.failed] == [['a1', 'a2']]
+        assert sender.failed[0][0].attempts == settings.SEND_ATTEMPTS
+
+    def test_rate(self, monkeypatch):
+        clock = [0.0]
+        sent_at = []
+        real_sleep = asyncio.sleep
+
+        async def sleep(delay):
+            # the buckets' waits pass at once on the fake clock
+            clock[0] += delay
+            await real_sleep(0)
+
+        class ClockedBot(FakeBot):
+            async def send_message(self, chat_id, text, **kwargs):
+                sent_at.append(clock[0])
+                await super().send_message(chat_id, text, **kwargs)
+
+        monkeypatch.setattr(sender_module, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+        monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+        async def main():
+            sender = Sender(ClockedBot(), 4, 100, 1000)
+            for c in range(150):
+                sender.put(c, Message(c, 'x', {}, 'message'))
+            while sender.chats:
+                await real_sleep(0)
+            await sender.stop(0)
+
+        asyncio.run(main())
+        assert len(sent_at) == 150
+        # 100 at once from the full bucket, the other 50 at 100 a second
+        assert sent_at[99] == 0
+        assert sent_at[-1] == pytest.approx(0.5, abs=0.01)
+
+
+class TestDigest:
+    items = [(f"<a href='https://abc.com/{i}'>{'t' * (i * 7 % 120)}</a><b> - abc</b>", f'SEEN;{i}') for i in range(200)]
+
+    def test_pack(self):
+        digests = pack(self.items)
+        assert len(digests) < 10
+        assert all(len(text) <= MESSAGE_LIMIT for text, keyboard in digests)
+        assert sum((digest_seens(keyboard) for text, keyboard in digests), []) == [seen for text, seen in self.items]
+        assert digests[1][0].startswith('1. ')
+
+    def test_long_item(self):
+        digests = pack(self.items[:2] + [('x' * MESSAGE_LIMIT, 'SEEN;long')] + self.items[2:4])
+        assert [text for text, keyboard in digests][1] == 'x' * MESSAGE_LIMIT
+        assert len(digests) == 3
+
+    def test_escaped(self):
+        site = Site(id=1, name='Tom & Jerry <news>')
+        posts = [SiteUnseenPost(id=i, url=f'https://abc.com/?a={i}&b="x"', title=f'1 < 2 & {i}') for i in range(3)]
+        text = pack([post_item(site, p) for p in posts])[0][0]
+        root = ElementTree.fromstring(f'<digest>{text}</digest>')
+        assert [a.get('href') for a in root.iter('a')] == [p.url for p in posts]
+        assert root.find('a').text == '1 < 2 & 0'
+
+    def test_seen(self):
+        keyboard = pack(self.items[:3])[0][1]
+        keyboard = without_button(keyboard, 'DSEEN;1')
+        assert digest_seens(keyboard) == ['SEEN;0', 'SEEN;2']
+
+
+class TestSubscribers:
+
+    def test_of(self):
+        everyone, a, b = Client(id=1), Client(id=2), Client(id=3)
+        subscribers = Subscribers([everyone], {10: [a, b], 11: [b]})
+        assert subscribers.of(Site(id=10)) == [everyone, a, b]
+        assert subscribers.of(Site(id=11)) == [everyone, b]
+        assert subscribers.of(Site(id=12)) == [everyone]
+
+
+class TestSettle:
+
+    def run(self, monkeypatch, done=(), failed=(), broken=False):
+        fake = Sender(FakeBot(), 1, 1, 1)
+        fake.done = list(done)
+        fake.failed = [list(q) for q in failed]
+        calls = []
+
+        def delete_messages(ids):
+            if broken:
+                raise ConnectionError('Database is gone')
+            calls.append(('delete', ids))
+
+        def release_messages(ids, delay=None, failed=None):
+            calls.append(('release', ids, delay, failed))
+        monkeypatch.setattr(outbox, 'sender', fake)
+        monkeypatch.setattr(outbox, 'delete_messages', delete_messages)
+        monkeypatch.setattr(outbox, 'release_messages', release_messages)
+        if broken:
+            with pytest.raises(ConnectionError):
+                outbox.settle()
+        else:
+            outbox.settle()
+        return fake, calls
+
+    def message(self, id, retries=0):
+        return Message(id, f'm{id}', {}, 'message', retries)
+
+    def test_done_deleted(self, monkeypatch):
+        fake, calls = self.run(monkeypatch, done=[self.message(1), self.message(2)])
+        assert calls == [('delete', [1, 2])]
+        assert not fake.done
+
+    def test_failed_put_back(self, monkeypatch):
+        queue = [self.message(3, retries=2), self.message(4), self.message(5)]
+        fake, calls = self.run(monkeypatch, failed=[queue])
+        assert calls == [('delete', []), ('release', [3, 4, 5], retry_delay(2), 3)]
+        assert retry_delay(2) == settings.OUTBOX_RETRY_INTERVAL * 4
+        assert not fake.failed
+
+    def test_dropped_after_attempts(self, monkeypatch):
+        queue = [self.message(6, retries=settings.OUTBOX_ATTEMPTS - 1), self.message(7)]
+        fake, calls = self.run(monkeypatch, failed=[queue])
+        assert calls == [('delete', []), ('delete', [6]), ('release', [7], None, None)]
+
+    def test_kept_when_database_fails(self, monkeypatch):
+        fake, calls = self.run(monkeypatch, done=[self.message(8)], failed=[[self.message(9)]], broken=True)
+        assert [m.id for m in fake.done] == [8]
+        assert [[m.id for m in q] for q in fake.failed] == [[9]]
@@ -1,7 +1,15 @@
 import pytest
+import json
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
 from .base import getAbsPath
-from tgnotifier.utils.helpers.scraper import OrderedAutoScraper
-from tgnotifier.utils.sites import clear_ads
+from tgnotifier.utils.helpers.scraper import OrderedAutoScraper, TextIndex, FuzzyText, find_all_multiple, text_match
+from tgnotifier.utils.helpers.title import TitleParser
+from tgnotifier.utils.helpers.program import StackProgram, get_program, extract
+from tgnotifier.utils.helpers.engines import SoupEngine, LxmlEngine
+from tgnotifier.utils.sites import clear_ads, get_fingerprint, filter_new_posts, is_burst
 
 class TestBuild:
     scraper = OrderedAutoScraper()
@@ -95,6 +103,55 @@ class TestBuild:
         assert results == []
 
 
+class TestTextIndex:
+
+    def test_same_as_tree(self):
+        for site, url in [('site1.txt', 'https://xakep.ru/'), ('site2.txt', 'https://thehackernews.com/')]:
+            with open(getAbsPath(site), 'r') as f:
+                soup = OrderedAutoScraper._get_soup(f.read())
+            index = TextIndex(soup, url)
+            assert index.elements == soup.findChildren()
+            for el in index.elements:
+                assert index.text(el) == el.getText().strip()
+                assert index.non_rec_text(el) == ''.join(el.find_all(text=True, recursive=False)).strip()
+
+    def test_candidates(self):
+        soup = OrderedAutoScraper._get_soup('<div><a href="/1">x</a><p>y<a href="https://abc.com/1" title="x">z</a></p></div>')
+        index = TextIndex(soup, 'https://abc.com/')
+        assert [c.name for c in index.candidates('https://abc.com/1', 1.0)] == ['a', 'a']
+        assert [c.name for c in index.candidates('x', 1.0)] == ['a', 'a']
+        assert index.candidates('yz', 1.0)[0].name == 'p'
+        assert [c.name for c in index.candidates('x', 0.9)] == ['a', 'p', 'a']
+        assert len(index.candidates('xyz', 0.5)) == len(index.elements)
+
+
+class TestFuzzyMatch:
+
+    def test_same_as_ratio(self):
+        random.seed(0)
+        words = ['post', 'posts', 'item', 'news-item', 'clearfix', 'col-md-4', 'Новости', '']
+        texts = words + [' '.join(random.choice(words) for j in range(random.randint(1, 6))) for i in range(100)]
+        for t1 in texts[:30]:
+            for t2 in texts:
+                for ratio in (0.5, 0.8, 0.95):
+                    expected = SequenceMatcher(None, t1, t2).ratio() >= ratio
+                    assert text_match(t1, t2, ratio) == expected
+                    assert FuzzyText(t1, ratio).search(t2) == expected
+
+
+class TestFindAllMultiple:
+
+    def test_order(self):
+        soup = OrderedAutoScraper._get_soup('<div><p class="a b" style="x">1</p><p style="y">2</p><span>3</span><p>4</p></div>')
+        targets = [{'name': 'p', 'attrs': {'class': '', 'style': ''}},
+            {'name': 'span', 'attrs': {'class': '', 'style': ''}},
+            {'name': 'p', 'attrs': {'class': ['b'], 'style': 'x'}},
+            {'name': 'p', 'attrs': {'class': '', 'style': 'y'}},
+            {'name': 'p', 'attrs': {'class': ['a', 'b']}}]
+        found = [(f.getText(), idx) for f, idx in find_all_multiple(soup.div, targets, recursive=False)]
+        assert found == [('1', 2), ('1', 4), ('2', 3), ('3', 1), ('4', 0)]
+
+
 class TestGetResults:
     scraper = OrderedAutoScraper()
 
@@ -122,6 +179,79 @@ class TestGetResults:
         assert results == []
 
 
+class TestStackProgram:
+    pages = [('stack1.txt', 'site1.txt', 'https://xakep.ru/'), ('stack2.txt', 'site2.txt', 'https://thehackernews.com/')]
+
+    def load(self, fname):
+        with open(getAbsPath(fname), 'r') as f:
+            return f.read()
+
+    @pytest.mark.parametrize('engine', [SoupEngine, LxmlEngine])
+    @pytest.mark.parametrize('attr_fuzz_ratio', [1.0, 0.8])
+    def test_same_as_scraper(self, attr_fuzz_ratio, engine):
+        for stack, site, url in self.pages:
+            stack, html = self.load(stack), self.load(site)
+            scraper = OrderedAutoScraper()
+            scraper.loadFromStr(stack)
+            expected = scraper.get_result_similar(url, html, attr_fuzz_ratio)
+            assert expected
+            assert get_program(stack, attr_fuzz_ratio).get_result_similar(url, html, engine=engine) == expected
+
+    @pytest.mark.parametrize('engine', [SoupEngine, LxmlEngine])
+    def test_built_stacks(self, engine):
+        for posts, site, url in [(['https://xakep.ru/2023/06/02/triangle_check/', 'https://xakep.ru/2023/06/02/flipper-zero-review/'], 'site1.txt', 'https://xakep.ru/'),
+                (['https://thehackernews.com/2023/06/new-linux-ransomware-strain-blacksuit.html', 'https://thehackernews.com/2023/06/ftc-slams-amazon-with-308m-fine-for.html'], 'site2.txt', 'https://thehackernews.com/')]:
+            html = self.load(site)
+            scraper = OrderedAutoScraper()
+            results = scraper.build(posts, url, html, wanted_titles={posts[0]: 'title'}, with_titles=True)
+            assert results
+            program = StackProgram(json.loads(scraper.dumpToStr())['stack_list'])
+            assert program.get_result_similar(url, html, with_titles=True, engine=engine) == results
+
+    @pytest.mark.parametrize('engine', [SoupEngine, LxmlEngine])
+    def test_normalization(self, engine):
+        html = '<div><p><a href="/1?a=1&amp;b=2">Ёлка&nbsp;и&nbsp;&laquo;ёж&raquo;</a></p><p><a href="/2">Йод &amp;amp; Ña</a></p></div>'
+        scraper = OrderedAutoScraper()
+        results = scraper.build(['https://abc.com/1?a=1&b=2'], 'https://abc.com/', html,
+            wanted_titles={'https://abc.com/1?a=1&b=2': 'Ёлка и «ёж»'}, with_titles=True)
+        assert len(results) == 2
+        program = StackProgram(json.loads(scraper.dumpToStr())['stack_list'])
+        assert program.get_result_similar('https://abc.com/', html, with_titles=True, engine=engine) == results
+
+    def test_cache(self):
+        stack = self.load('stack2.txt')
+        program = get_program(stack)
+        assert get_program(stack) is program
+        assert get_program(stack, 0.8) is not program
+
+    def test_extract_in_process(self):
+        stack, html = self.load('stack2.txt'), self.load('site2.txt')
+        url = 'https://thehackernews.com/'
+        expected = get_program(stack).get_result_similar(url, html, with_titles=True)
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            assert pool.submit(extract, url, stack, html, True, 'lxml').result() == expected
+
+
+class TestLxmlEngine:
+
+    def test_text(self):
+        html = '<div id="a"> <p>a <!----> b</p>\n  <script>var a</script><pre> x \n </pre><template><i>t</i></template></div>'
+        soup, tree = SoupEngine.parse(html), LxmlEngine.parse(html)
+        div, el = soup.find(id='a'), tree.root.find('.//div')
+        assert LxmlEngine.text(el) == SoupEngine.text(div)
+        assert LxmlEngine.non_rec_text(el.find('p')) == SoupEngine.non_rec_text(div.p)
+        assert LxmlEngine.text(el.find('script')) == 'var a'
+
+    def test_attrs(self):
+        tree = LxmlEngine.parse('<a class=" x  y " rel="nofollow me" title="a b">t</a>')
+        a = tree.root.find('.//a')
+        assert LxmlEngine.attr(a, 'class') == ['x', 'y']
+        assert LxmlEngine.attr(a, 'rel') == ['nofollow', 'me']
+        assert LxmlEngine.attr(a, 'title') == 'a b'
+        assert LxmlEngine.attr(a, 'style') is None
+        assert LxmlEngine.name(LxmlEngine.parent(tree.root)) == '[document]'
+
+
 class TestClearAds:
 
     def test_all_urls_same_domain(self):
@@ -142,3 +272,94 @@ class TestClearAds:
         posts = ["https://abc.com/1.html", "https://abc.com/2.html", 
            "https://hgj.com/1.html", "https://abc.net/2.html", "https://dot.abc.com/2"]
         assert clear_ads(target, posts) == ["https://abc.com/1.html", "https://abc.com/2.html"]
+
+
+class TestBurst:
+    last = {f'https://abc.com/{i}': None for i in range(10)}
+
+    def check(self, page):
+        posts = [(u, None) for u in page]
+        new, posts = filter_new_posts(self.last, posts)
+        return is_burst(self.last, posts, new)
+
+    def test_news(self):
+        assert not self.check([f'https://abc.com/{i}' for i in range(10, 13)] + list(self.last))
+
+    def test_changed_urls(self):
+        assert self.check([f'https://abc.com/new/{i}' for i in range(10)])
+
+    def test_mostly_new(self):
+        assert self.check([f'https://abc.com/{i}' for i in range(10, 19)] + ['https://abc.com/0'])
+
+    def test_few_posts(self):
+        assert not self.check(['https://abc.com/new/1', 'https://abc.com/new/2'])
+
+    def test_first_poll(self):
+        assert not is_burst({}, [('https://abc.com/1', None)] * 10, [('https://abc.com/1', None)] * 10)
+
+
+class TestFingerprint:
+
+    def test_ignores_noise(self):
+        html = '<body><a href="/1">1</a>\n  <a href="/2">2</a></body>'
+        noisy = '<body><script>var t = 1;</script><a href="/1">1</a> <!-- ad -->\n<style>a {}</style><a href="/2">2</a></body>'
+        assert get_fingerprint('stack', html) == get_fingerprint('stack', noisy)
+
+    def test_changes(self):
+        html = '<body><a href="/1">1</a></body>'
+        assert get_fingerprint('stack', html) != get_fingerprint('stack', '<body><a href="/2">1</a></body>')
+        assert get_fingerprint('stack', html) != get_fingerprint('other stack', html)
+
+
+class TestTitles:
+    scraper = OrderedAutoScraper()
+
+    def test_title_rule(self):
+        html = None
+        with open(getAbsPath('site2.txt'), 'r') as f:
+            html = f.read()
+        post = 'https://thehackernews.com/2023/06/new-linux-ransomware-strain-blacksuit.html'
+        results = self.scraper.build([post], 'https://thehackernews.com/', html=html,
+            wanted_titles={post: 'New Linux Ransomware Strain BlackSuit Shows Striking Similarities to Royal | The Hacker News'},
+            with_titles=True)
+        assert results[:3] == [(post, 'New Linux Ransomware Strain BlackSuit Shows Striking Similarities to Royal'),
+ ('https://thehackernews.com/2023/06/cloud-security-tops-concerns-for.html', "Cloud Security Tops Concerns for Cybersecurity Leaders: EC-Council's Certified CISO Hall of Fame Report 2023"),
+ ('https://thn.news/wing-newsfeed-5', 'Say Goodbye to SaaS Blind Spots: Wing Security Unveils Free Discovery Tool')]
+        scraper = OrderedAutoScraper()
+        scraper.loadFromStr(self.scraper.dumpToStr())
+        assert scraper.get_result_similar('https://thehackernews.com/', html, with_titles=True) == results
+
+    def test_without_title_rule(self):
+        html = None
+        with open(getAbsPath('site2.txt'), 'r') as f:
+            html = f.read()
+        self.scraper.loadFromFile(getAbsPath('stack2.txt'))
+        results = self.scraper.get_result_similar('https://thehackernews.com/', html, with_titles=True)
+        assert results[0] == ('https://thehackernews.com/2023/06/new-linux-ransomware-strain-blacksuit.html', None)
+        assert len(results) == 10
+
+
+class TestTitleParser:
+
+    def feed(self, body, chunk_size=100, charset=None):
+        parser = TitleParser(charset)
+        for i in range(0, len(body), chunk_size):
+            if parser.feed_bytes(body[i:i+chunk_size]):
+                return (parser.title, i + chunk_size)
+        parser.close()
+        return (parser.title, len(body))
+
+    def test_stops_after_title(self):
+        with open(getAbsPath('site1.txt'), 'rb') as f:
+            body = f.read()
+        title, read = self.feed(body)
+        assert title == 'Хакер — Безопасность, разработка, DevOps'
+        assert read < len(body) // 10
+
+    def test_og_title_and_charset(self):
+        body = '<html><head><meta charset="windows-1251"><meta property="og:title" content="Новость &amp; дня"></head><body></body></html>'
+        assert self.feed(body.encode('cp1251'), chunk_size=7)[0] == 'Новость & дня'
+
+    def test_no_title(self):
+        assert self.feed(b'<html><head></head><body><h1>Title</h1></body></html>')[0] == None
+        assert self.feed(b'hfhfhfhfhf')[0] == None
@@ -1,3 +1,5 @@
 import pytest
 from tgnotifier.tests.sites import *
-from tgnotifier.tests.youtube import *
\ No newline at end of file
+from tgnotifier.tests.youtube import *
+from tgnotifier.tests.scheduler import *
+from tgnotifier.tests.sender import *
\ No newline at end of file
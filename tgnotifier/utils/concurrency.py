@@ -0,0 +1,96 @@
+import asyncio
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlparse
+from tgnotifier.core.settings import settings
+
+class HostLimiter:
+	"""
+	Limits the number of tasks running at once, globally and per host.
+	Must be created inside the running event loop.
+	"""
+
+	def __init__(self, limit, per_host):
+		self.total = asyncio.Semaphore(limit)
+		self.hosts = defaultdict(lambda: asyncio.Semaphore(per_host))
+
+	@asynccontextmanager
+	async def acquire(self, url):
+		# Host slot first, so a task waiting for a busy host doesn't hold a global slot.
+		async with self.hosts[urlparse(url).netloc]:
+			async with self.total:
+				yield
+
+
+executor = None
+
+def get_executor():
+	"""
+	Pool of processes for CPU-bound work, None if PARSE_WORKERS is 0.
+	Workers are spawned rather than forked, so they don't inherit
+	the event loop, open sockets and threads of the app.
+	"""
+	global executor
+	if executor is None and settings.PARSE_WORKERS > 0:
+		executor = ProcessPoolExecutor(settings.PARSE_WORKERS,
+			mp_context=multiprocessing.get_context('spawn'))
+	return executor
+
+async def run_cpu_bound(func, *args):
+	"""
+	Runs a picklable function in the process pool, or in a thread if there is none.
+	"""
+	pool = get_executor()
+	if pool is None:
+		return await asyncio.to_thread(func, *args)
+	try:
+		return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+	except BrokenProcessPool:
+		# a worker died, the next call starts a new pool
+		shutdown_executor()
+		raise
+
+def shutdown_executor():
+	global executor
+	if executor is not None:
+		executor.shutdown(wait=False, cancel_futures=True)
+	executor = None
+
+
+deadline = ContextVar('deadline', default=None)
+
+def time_left():
+	"""
+	Seconds left till the deadline of the running task, None if it has none.
+	"""
+	at = deadline.get()
+	if at is None:
+		return None
+	return at - asyncio.get_running_loop().time()
+
+@contextmanager
+def budget(seconds):
+	"""
+	Sets the deadline in `seconds`, or keeps the current one if it comes earlier.
+	Tasks started inside inherit it.
+	"""
+	left = time_left()
+	if left is not None and left < seconds:
+		seconds = left
+	token = deadline.set(asyncio.get_running_loop().time() + seconds)
+	try:
+		yield seconds
+	finally:
+		deadline.reset(token)
+
+async def run_with_budget(coro, seconds):
+	"""
+	Awaits the coroutine within the budget, cancelling it when it runs out.
+	Raises asyncio.TimeoutError then.
+	"""
+	with budget(seconds) as seconds:
+		return await asyncio.wait_for(coro, max(seconds, 0))
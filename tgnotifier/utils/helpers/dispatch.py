@@ -0,0 +1,74 @@
+"""
+Lookup of the targets an element may match.
+Targets are grouped by tag name and, inside a group, by the value of an
+attribute they compare exactly, so an element is tested only against the
+targets with its name and its value of that attribute.
+"""
+from bs4.builder import HTMLTreeBuilder
+
+CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+
+
+def exact_attrs(name, attrs):
+    """
+    Attributes compared by plain equality. An empty value also matches a missing attribute.
+    Multi-valued ones (class) match on any of their items, so they are left out.
+    """
+    multi_valued = set(CDATA_LIST_ATTRIBUTES['*']) | set(CDATA_LIST_ATTRIBUTES.get(name, ()))
+    return {k: v for k, v in attrs.items() if isinstance(v, str) and k not in multi_valued}
+
+
+class Dispatch(object):
+
+    def __init__(self, targets):
+        """
+        `targets` are (name, exact attributes, payload) triples.
+        Targets without a plain name are tried on every element.
+        """
+        self.groups = {}
+        self.generic = []
+        for order, (name, exact, payload) in enumerate(targets):
+            if not isinstance(name, str) or not name:
+                self.generic.append((order, payload))
+                continue
+            group = self.groups.get(name)
+            if group is None:
+                group = self.groups[name] = (next(iter(exact), None), {}, [])
+            key, by_value, others = group
+            if key is not None and key in exact:
+                by_value.setdefault(exact[key], []).append((order, payload))
+            else:
+                others.append((order, payload))
+
+    def _group_candidates(self, name, attr):
+        group = self.groups.get(name)
+        if group is None:
+            return []
+        key, by_value, others = group
+        if key is None:
+            return others
+        value = attr(key)
+        found = by_value.get('' if value is None else value)
+        if not found:
+            return others
+        if not others:
+            return found
+        return sorted(found + others)
+
+    def candidates(self, name, prefix, attr):
+        """
+        Payloads of the targets an element may match, in the order of the targets.
+        `attr` gets a value of the element's attribute.
+        """
+        lists = [self._group_candidates(name, attr), self.generic]
+        if prefix:
+            lists.append(self._group_candidates(f'{prefix}:{name}', attr))
+        lists = [l for l in lists if l]
+        if not lists:
+            return []
+        if len(lists) == 1:
+            return [payload for order, payload in lists[0]]
+        return [payload for order, payload in sorted(sum(lists, []))]
+
+    def generic_candidates(self):
+        return [payload for order, payload in self.generic]
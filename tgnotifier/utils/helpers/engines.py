@@ -0,0 +1,214 @@
+"""
+Tree engines for compiled stacks.
+An engine parses a page and gives the program access to its elements.
+SoupEngine works on BeautifulSoup and is the reference one. LxmlEngine
+runs on a bare lxml tree and reproduces what BeautifulSoup builds on
+top of the same parser: the [document] root, multi-valued attributes
+split into lists and the strings get_text() takes into account.
+
+Pages are parsed as they are. Unescaping and NFKD normalization, which
+OrderedAutoScraper applies to the whole document, are applied only to the
+text and attribute values the program compares or returns.
+"""
+from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder, nonwhitespace_re
+from bs4.element import Tag
+from lxml import etree
+from html import unescape
+import unicodedata
+
+DOCUMENT = "[document]"
+
+CDATA_LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+PRESERVE_WHITESPACE_TAGS = HTMLTreeBuilder.DEFAULT_PRESERVE_WHITESPACE_TAGS
+STRING_CONTAINERS = set(HTMLTreeBuilder.DEFAULT_STRING_CONTAINERS)
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+def normalize_value(s):
+    if s.isascii() and '&' not in s:
+        return s
+    return unicodedata.normalize("NFKD", unescape(s))
+
+def normalize_attr(value):
+    if value is None:
+        return None
+    if isinstance(value, list):
+        return [normalize_value(v) for v in value]
+    return normalize_value(value)
+
+def collapse(s, preserve):
+    """
+    BeautifulSoup replaces whitespace-only strings with a single newline or space.
+    """
+    if preserve or s.strip(ASCII_SPACES):
+        return s
+    return '\n' if '\n' in s else ' '
+
+
+class SoupEngine:
+    """
+    Access to the nodes of a BeautifulSoup tree.
+    """
+
+    @staticmethod
+    def parse(html):
+        return BeautifulSoup(html, "lxml")
+
+    @staticmethod
+    def children(node):
+        return [c for c in node.contents if isinstance(c, Tag)]
+
+    @staticmethod
+    def name(node):
+        return node.name
+
+    @staticmethod
+    def prefix(node):
+        return node.prefix
+
+    @staticmethod
+    def attr(node, key):
+        return normalize_attr(node.attrs.get(key))
+
+    @staticmethod
+    def parent(node):
+        return node.parent
+
+    @staticmethod
+    def _string(s):
+        n = normalize_value(s)
+        if n is s or n.strip(ASCII_SPACES):
+            return n
+        # the string became whitespace-only (&nbsp;), the parser would have collapsed it
+        return collapse(n, any(p.name in PRESERVE_WHITESPACE_TAGS for p in s.parents))
+
+    @classmethod
+    def text(cls, node):
+        return ''.join(cls._string(s) for s in node.strings)
+
+    @classmethod
+    def non_rec_text(cls, node):
+        return ''.join(cls._string(s) for s in node.find_all(text=True, recursive=False)).strip()
+
+
+class Document:
+    """
+    Root above the <html> element, BeautifulSoup's [document].
+    """
+
+    __slots__ = ('root',)
+
+    def __init__(self, root):
+        self.root = root
+
+
+def get_context(node):
+    """
+    The closest string container (script, style, ...) of the node's strings
+    and whether their whitespace is preserved.
+    """
+    container = None
+    preserve = False
+    while node is not None:
+        if container is None and node.tag in STRING_CONTAINERS:
+            container = node.tag
+        if node.tag in PRESERVE_WHITESPACE_TAGS:
+            preserve = True
+        node = node.getparent()
+    return (container, preserve)
+
+
+class LxmlEngine:
+    """
+    Access to the nodes of an lxml tree, as if it were built by BeautifulSoup.
+    """
+
+    @staticmethod
+    def parse(html):
+        try:
+            root = etree.HTML(html, etree.HTMLParser())
+        except ValueError:
+            root = etree.HTML(html.encode('utf-8'), etree.HTMLParser(encoding='utf-8'))
+        return Document(root)
+
+    @staticmethod
+    def children(node):
+        if isinstance(node, Document):
+            return [] if node.root is None else [node.root]
+        return list(node.iterchildren(etree.Element))
+
+    @staticmethod
+    def name(node):
+        if isinstance(node, Document):
+            return DOCUMENT
+        return node.tag
+
+    @staticmethod
+    def prefix(node):
+        return None
+
+    @staticmethod
+    def attr(node, key):
+        if isinstance(node, Document):
+            return None
+        value = node.get(key)
+        if value is not None and (key in CDATA_LIST_ATTRIBUTES['*']
+                or key in CDATA_LIST_ATTRIBUTES.get(node.tag, ())):
+            return [normalize_value(v) for v in nonwhitespace_re.findall(value)]
+        return None if value is None else normalize_value(value)
+
+    @staticmethod
+    def parent(node):
+        if isinstance(node, Document):
+            return None
+        parent = node.getparent()
+        return Document(node) if parent is None else parent
+
+    @classmethod
+    def text(cls, node):
+        if isinstance(node, Document):
+            node = node.root
+            if node is None:
+                return ''
+        container, preserve = get_context(node)
+        wanted = node.tag if node.tag in STRING_CONTAINERS else None
+        parts = []
+        cls._collect_text(node, container, preserve, wanted, parts)
+        return ''.join(parts)
+
+    @classmethod
+    def _collect_text(cls, node, container, preserve, wanted, parts):
+        if node.text and container == wanted:
+            parts.append(collapse(normalize_value(node.text), preserve))
+        for child in node:
+            if isinstance(child.tag, str):
+                cls._collect_text(child,
+                    child.tag if child.tag in STRING_CONTAINERS else container,
+                    preserve or child.tag in PRESERVE_WHITESPACE_TAGS,
+                    wanted, parts)
+            if child.tail and container == wanted:
+                parts.append(collapse(normalize_value(child.tail), preserve))
+
+    @staticmethod
+    def non_rec_text(node):
+        if isinstance(node, Document):
+            return ''
+        preserve = get_context(node)[1]
+        parts = [node.text] if node.text else []
+        for child in node:
+            if child.tag is etree.Comment:
+                # even an empty comment is kept by BeautifulSoup, as a space
+                parts.append(child.text or '')
+            if child.tail:
+                parts.append(child.tail)
+        return ''.join(collapse(normalize_value(s), preserve) for s in parts).strip()
+
+
+engines = {'bs4': SoupEngine, 'lxml': LxmlEngine}
+
+def get_engine(name):
+    try:
+        return engines[name]
+    except KeyError:
+        raise Exception(f"Unknown scraper engine: {name}.")
@@ -0,0 +1,244 @@
+"""
+Compiled stacks.
+A stack is turned once into a tree of steps with prebuilt tag matchers and then
+run against any number of pages. Matching follows BeautifulSoup's
+findAll(name, attrs, recursive=False), so the results are the same as the ones
+of OrderedAutoScraper.get_result_similar.
+"""
+from urllib.parse import urljoin
+from collections import OrderedDict
+from tgnotifier.core.settings import settings
+from .scraper import FuzzyText, unique_results
+from .engines import DOCUMENT, SoupEngine, get_engine
+from .dispatch import Dispatch, exact_attrs
+import hashlib
+import json
+
+
+def compile_single(value):
+    if isinstance(value, str):
+        return lambda s: s == value
+    if hasattr(value, 'search'):
+        return lambda s: bool(value.search(s))
+    if value is None or isinstance(value, bool):
+        return lambda s: value is True
+    value = str(value)
+    return lambda s: s == value
+
+def compile_value(value, attr_fuzz_ratio=1.0):
+    """
+    Test of an attribute value the way SoupStrainer matches it:
+    a missing attribute matches an empty value, a multi-valued one (class)
+    matches if any of its items or all of them joined by spaces match.
+    """
+    if attr_fuzz_ratio < 1.0:
+        if isinstance(value, str) and value:
+            value = FuzzyText(value, attr_fuzz_ratio)
+        elif isinstance(value, (list, tuple)):
+            value = [FuzzyText(x, attr_fuzz_ratio) if x else x for x in value]
+
+    if isinstance(value, (list, tuple)):
+        tests = [compile_single(v) for v in value]
+        test_one = lambda s: any(t(s) for t in tests)
+    else:
+        test_one = compile_single(value)
+    missing = not value
+
+    def test(markup):
+        if markup is None:
+            return missing
+        if isinstance(markup, (list, tuple)):
+            return any(test_one(m) for m in markup) or test_one(' '.join(markup))
+        return test_one(markup)
+    return test
+
+
+class Step:
+    """
+    Matcher of the children with the given tag name and attributes.
+    """
+
+    __slots__ = ('name', 'tests', 'exact')
+
+    def __init__(self, name, attrs, attr_fuzz_ratio=1.0):
+        self.name = name
+        self.tests = tuple((k, compile_value(v, attr_fuzz_ratio)) for k, v in attrs.items())
+        # fuzzy comparison leaves only empty values exact
+        self.exact = exact_attrs(name, attrs if attr_fuzz_ratio >= 1.0 else
+            {k: v for k, v in attrs.items() if v == ""})
+
+    def matches(self, engine, node):
+        name = engine.name(node)
+        if name != self.name:
+            prefix = engine.prefix(node)
+            if not prefix or f'{prefix}:{name}' != self.name:
+                return False
+        for key, test in self.tests:
+            if not test(engine.attr(node, key)):
+                return False
+        return True
+
+    def find(self, engine, node):
+        return [c for c in engine.children(node) if self.matches(engine, c)]
+
+
+class TitleRule:
+
+    def __init__(self, rule):
+        self.up = rule["up"]
+        self.path = [(Step(name, attrs), idx) for name, attrs, idx in rule["path"]]
+
+    def fetch(self, engine, node):
+        for i in range(self.up):
+            node = engine.parent(node)
+            if node is None:
+                return None
+        for step, idx in self.path:
+            found = step.find(engine, node)
+            if not found:
+                return None
+            node = found[min(len(found) - 1, idx)]
+        return " ".join(engine.text(node).split()) or None
+
+
+class Extract:
+    """
+    Gets the wanted value (and the title) from the matched element.
+    """
+
+    def __init__(self, stack):
+        self.wanted_attr = stack["wanted_attr"]
+        self.is_full_url = stack["is_full_url"]
+        self.is_non_rec_text = stack.get("is_non_rec_text", False)
+        title = stack.get("title")
+        self.title = TitleRule(title) if title else None
+
+    def value(self, engine, node, url):
+        if self.wanted_attr is None:
+            if self.is_non_rec_text:
+                return engine.non_rec_text(node)
+            return engine.text(node).strip()
+
+        value = engine.attr(node, self.wanted_attr)
+        if value is None:
+            return None
+
+        if self.is_full_url:
+            return urljoin(url, value)
+
+        return value
+
+    def __call__(self, engine, node, url, with_titles):
+        value = self.value(engine, node, url)
+        if with_titles:
+            return (value, self.title.fetch(engine, node) if self.title else None)
+        return value
+
+
+class Walk:
+    """
+    Path of a single stack: every step keeps all the matching children,
+    except the last one, which keeps one per parent by its index.
+    `start` is the number of the stack's elements already matched.
+    """
+
+    def __init__(self, stack, start=0, attr_fuzz_ratio=1.0):
+        content = stack["content"]
+        self.steps = []
+        for index in range(start, len(content)):
+            item = content[index]
+            if item[0] == DOCUMENT:
+                continue
+            pick = content[index - 1][2] if index == len(content) - 1 else None
+            self.steps.append((Step(item[0], item[1], attr_fuzz_ratio), pick))
+        self.extract = Extract(stack)
+
+    def run(self, engine, parents, url, with_titles, results):
+        for step, pick in self.steps:
+            children = []
+            for parent in parents:
+                found = step.find(engine, parent)
+                if not found:
+                    continue
+                if pick is not None:
+                    found = [found[min(len(found) - 1, pick)]]
+                children += found
+            parents = children
+        results.extend(self.extract(engine, node, url, with_titles) for node in parents)
+
+
+class Branches:
+    """
+    Merged stacks: the common steps followed by the branches
+    tried in turn on every child of the elements they lead to.
+    A child is tried only on the branches its tag name and attributes allow.
+    """
+
+    def __init__(self, stacks, attr_fuzz_ratio=1.0):
+        self.steps = [Step(item[0], item[1], attr_fuzz_ratio)
+            for item in stacks[:-1] if item[0] != DOCUMENT]
+        branches = []
+        for branch in stacks[-1]:
+            if isinstance(branch, dict):
+                first = branch["content"][0]
+                then = Walk(branch, 1, attr_fuzz_ratio)
+            else:
+                first = branch[0]
+                then = Branches(branch[1:], attr_fuzz_ratio)
+            step = Step(first[0], first[1], attr_fuzz_ratio)
+            branches.append((step.name, step.exact, (step, then)))
+        self.dispatch = Dispatch(branches)
+
+    def run(self, engine, parents, url, with_titles, results):
+        for step in self.steps:
+            parents = [c for parent in parents for c in step.find(engine, parent)]
+        for parent in parents:
+            for child in engine.children(parent):
+                candidates = self.dispatch.candidates(engine.name(child), engine.prefix(child),
+                    lambda key: engine.attr(child, key))
+                for step, then in candidates:
+                    if step.matches(engine, child):
+                        then.run(engine, [child], url, with_titles, results)
+
+
+class StackProgram:
+
+    def __init__(self, stack_list, attr_fuzz_ratio=1.0):
+        if len(stack_list) > 1:
+            self.root = Branches(stack_list, attr_fuzz_ratio)
+        else:
+            self.root = Walk(stack_list[0], 0, attr_fuzz_ratio)
+
+    def run(self, root, url, with_titles=False, engine=SoupEngine):
+        results = []
+        self.root.run(engine, [root], url, with_titles, results)
+        return unique_results(results, with_titles)
+
+    def get_result_similar(self, url, html, with_titles=False, engine=SoupEngine):
+        return self.run(engine.parse(html), url, with_titles, engine)
+
+
+programs = OrderedDict()
+
+def get_program(stack, attr_fuzz_ratio=1.0):
+    """
+    Compiled program of the stack text, cached with LRU eviction.
+    """
+    key = (hashlib.sha256(stack.encode('utf-8')).hexdigest(), attr_fuzz_ratio)
+    program = programs.get(key)
+    if program is None:
+        program = StackProgram(json.loads(stack)["stack_list"], attr_fuzz_ratio)
+        programs[key] = program
+        while len(programs) > settings.STACK_CACHE_SIZE:
+            programs.popitem(last=False)
+    else:
+        programs.move_to_end(key)
+    return program
+
+def extract(url, stack, html, with_titles=False, engine='bs4'):
+    """
+    Results of the stack text on the page.
+    Takes and returns only plain data, so it can run in a worker process,
+    which compiles the stack once into its own cache.
+    """
+    return get_program(stack).get_result_similar(url, html, with_titles, get_engine(engine))
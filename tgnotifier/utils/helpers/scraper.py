@@ -1,15 +1,17 @@
 from bs4 import BeautifulSoup, SoupStrainer
+from bs4.element import Tag, NavigableString, CData
 from html import unescape
-import requests
+from tgnotifier.utils import http
+from .dispatch import Dispatch, exact_attrs
 import unicodedata
 from urllib.parse import urljoin, urlparse
 from difflib import SequenceMatcher
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict, defaultdict, Counter
+from functools import lru_cache
 import hashlib
 import string
 import random
 import json
-import time
 
 def find_all_multiple(tg, targets, recursive=True):
     generator = tg.descendants
@@ -24,19 +26,24 @@ def find_all_multiple(tg, targets, recursive=True):
             strainers.append(name)
         else:
             strainers.append(SoupStrainer(**t))
+
+    dispatch = Dispatch((s.name, exact_attrs(s.name, s.attrs), (idx, s))
+        for idx, s in enumerate(strainers))
+    generic = dispatch.generic_candidates()
                 
     results = []
         
-    while True:
-        try:
-            i = next(generator)
-        except StopIteration:
-            break
-        if i:
-            for idx, s in enumerate(strainers):
-                found = s.search(i)
-                if found:
-                    results.append((found, idx))
+    for i in generator:
+        if not i:
+            continue
+        if isinstance(i, Tag):
+            candidates = dispatch.candidates(i.name, i.prefix, i.attrs.get)
+        else:
+            candidates = generic
+        for idx, s in candidates:
+            found = s.search(i)
+            if found:
+                results.append((found, idx))
     return results
 
 def normalize(item):
@@ -49,6 +56,32 @@ def text_match(t1, t2, ratio_limit):
         return bool(t1.fullmatch(t2))
     if ratio_limit >= 1:
         return t1 == t2
+    return fuzzy_match(t1, t2, ratio_limit)
+
+@lru_cache(maxsize=1024)
+def char_counts(text):
+    return Counter(text)
+
+def length_bound(l1, l2):
+    """
+    Upper bound of SequenceMatcher's ratio by the lengths of the texts (real_quick_ratio).
+    """
+    length = l1 + l2
+    return 2.0 * min(l1, l2) / length if length else 1.0
+
+def fuzzy_match(t1, t2, ratio_limit, counts=None):
+    """
+    SequenceMatcher(None, t1, t2).ratio() >= ratio_limit.
+    The ratio is only computed for texts whose upper bounds reach the limit:
+    the one by lengths, then the one by common characters (quick_ratio).
+    """
+    if length_bound(len(t1), len(t2)) < ratio_limit:
+        return False
+    if not t1 and not t2:
+        return True
+    common = sum(((counts or char_counts(t1)) & Counter(t2)).values())
+    if 2.0 * common / (len(t1) + len(t2)) < ratio_limit:
+        return False
     return SequenceMatcher(None, t1, t2).ratio() >= ratio_limit
     
 def unique_stack_list(stack_list):
@@ -66,6 +99,14 @@ def unique_stack_list(stack_list):
 def unique_hashable(hashable_items):
     return list(OrderedDict.fromkeys(hashable_items))
 
+def unique_results(results, with_titles=False):
+    if not with_titles:
+        return unique_hashable(results)
+    unique = OrderedDict()
+    for r in results:
+        unique.setdefault(r[0], r)
+    return list(unique.values())
+
 def list_duplicates(seq):
     tally = defaultdict(list)
     for i,item in enumerate(seq):
@@ -85,11 +126,83 @@ class FuzzyText(object):
         self.text = text
         self.ratio_limit = ratio_limit
         self.match = None
+        self.counts = Counter(text)
 
     def search(self, text):
-        return SequenceMatcher(None, self.text, text).ratio() >= self.ratio_limit
+        return fuzzy_match(self.text, text, self.ratio_limit, self.counts)
         
 
+class TextIndex(object):
+    """
+    Texts and attribute values of all the elements of a soup, gathered in one traversal.
+    `lookup` maps every value to the positions of the elements having it
+    (in the order of soup.findChildren()), so exact matches need no scan.
+    """
+
+    plain_strings = (NavigableString, CData)
+
+    def __init__(self, soup, url):
+        self.elements = []
+        self.texts = {}
+        self.non_rec_texts = {}
+        self.lookup = defaultdict(list)
+        self.containers = soup.builder.string_containers
+        self._visit(soup)
+        for pos, el in enumerate(self.elements):
+            values = {self.texts[id(el)], self.non_rec_texts[id(el)]}
+            for key, value in el.attrs.items():
+                if not isinstance(value, str):
+                    continue
+                value = value.strip()
+                values.add(value)
+                if key in {"href", "src"}:
+                    values.add(urljoin(url, value))
+            for value in values:
+                self.lookup[value].append(pos)
+
+    def _visit(self, tag):
+        """
+        Returns the text of the tag as its parent's get_text() sees it:
+        strings in scripts, styles and the like aren't included.
+        """
+        parts = []
+        own = []
+        for c in tag.contents:
+            if isinstance(c, Tag):
+                self.elements.append(c)
+                text = self._visit(c)
+                if c.name not in self.containers:
+                    parts.append(text)
+            else:
+                own.append(c)
+                if type(c) in self.plain_strings:
+                    parts.append(c)
+        text = ''.join(parts)
+        self.texts[id(tag)] = (tag.getText() if tag.name in self.containers else text).strip()
+        self.non_rec_texts[id(tag)] = ''.join(own).strip()
+        return text
+
+    def text(self, tag):
+        return self.texts[id(tag)]
+
+    def non_rec_text(self, tag):
+        return self.non_rec_texts[id(tag)]
+
+    def candidates(self, text, text_fuzz_ratio):
+        """
+        Elements that may have the text, last ones first.
+        """
+        if not isinstance(text, str):
+            return list(reversed(self.elements))
+        if text_fuzz_ratio >= 1:
+            return [self.elements[i] for i in reversed(self.lookup.get(text, []))]
+        positions = set()
+        for value, found in self.lookup.items():
+            if length_bound(len(text), len(value)) >= text_fuzz_ratio:
+                positions.update(found)
+        return [self.elements[i] for i in sorted(positions, reverse=True)]
+
+
 class OrderedAutoScraper():
 
     request_headers = {
@@ -100,11 +213,14 @@ class OrderedAutoScraper():
     reconnect_attempts = 3
     reconnect_interval = 1
 
+    title_ratio_limit = 0.5
+    title_max_up = 3
+
     def __init__(self, stack_list=[]):
         self.stack_list = stack_list
     
     @classmethod
-    def _fetch_html(cls, url, request_args=None):
+    async def _fetch_html(cls, url, request_args=None):
         request_args = request_args or {}
         headers = dict(cls.request_headers)
         if url:
@@ -112,49 +228,32 @@ class OrderedAutoScraper():
 
         user_headers = request_args.pop("headers", {})
         headers.update(user_headers)
-        for i in range(cls.reconnect_attempts):
-            try:
-                res = requests.get(url, headers=headers, **request_args)
-                if res.status_code == 200:
-                    break
-                else:
-                    time.sleep(cls.reconnect_interval)
-            except:
-                time.sleep(cls.reconnect_interval)
-        if res.status_code == 200:
-            if res.encoding == "ISO-8859-1" and not "ISO-8859-1" in res.headers.get(
-                "Content-Type", ""
-            ):
-                res.encoding = res.apparent_encoding
-            html = res.text
-            return html
-        else:
+        try:
+            res = await http.get(url, headers=headers, attempts=cls.reconnect_attempts,
+                interval=cls.reconnect_interval, **request_args)
+        except http.HttpError:
             raise Exception("Unable to get a valid response from site.")
+        return res.text()
     
     @classmethod
-    def _get_soup(cls, url=None, html=None, request_args=None):
-        if html:
-            html = normalize(unescape(html))
-            return BeautifulSoup(html, "lxml")
-
-        html = cls._fetch_html(url, request_args)
+    def _get_soup(cls, html):
         html = normalize(unescape(html))
-
         return BeautifulSoup(html, "lxml")
         
     @staticmethod
-    def _child_has_text(child, text, url, text_fuzz_ratio):
-        child_text = child.getText().strip()
+    def _child_has_text(child, text, url, text_fuzz_ratio, index=None):
+        child_text = index.text(child) if index else child.getText().strip()
 
         if text_match(text, child_text, text_fuzz_ratio):
-            parent_text = child.parent.getText().strip()
+            parent_text = index.text(child.parent) if index else child.parent.getText().strip()
             if child_text == parent_text and child.parent.parent:
                 return False
 
             child.wanted_attr = None
             return True
 
-        if text_match(text, get_non_rec_text(child), text_fuzz_ratio):
+        non_rec_text = index.non_rec_text(child) if index else get_non_rec_text(child)
+        if text_match(text, non_rec_text, text_fuzz_ratio):
             child.is_non_rec_text = True
             child.wanted_attr = None
             return True
@@ -177,10 +276,10 @@ class OrderedAutoScraper():
 
         return False
     
-    def _get_children(self, soup, text, url, text_fuzz_ratio):
-        children = reversed(soup.findChildren())
+    def _get_children(self, soup, text, url, text_fuzz_ratio, index=None):
+        children = index.candidates(text, text_fuzz_ratio) if index else reversed(soup.findChildren())
         children = [
-            x for x in children if self._child_has_text(x, text, url, text_fuzz_ratio)
+            x for x in children if self._child_has_text(x, text, url, text_fuzz_ratio, index)
         ]
         return children
         
@@ -207,21 +306,26 @@ class OrderedAutoScraper():
             attrs[key] = val
         return attrs
         
-    def build(self, wanted_list, url=None, html=None, text_fuzz_ratio=1.0):
+    def build(self, wanted_list, url, html, text_fuzz_ratio=1.0, wanted_titles=None, with_titles=False):
     
-        soup = self._get_soup(url=url, html=html)
+        soup = self._get_soup(html)
         
         result_list = []
 
+        wanted_titles = wanted_titles or {}
+        titles = [normalize(wanted_titles.get(x)) for x in wanted_list]
         wanted_list = [normalize(x) for x in wanted_list]
         
         stack_list = []
+        index = TextIndex(soup, url)
 
-        for wanted in wanted_list:
-            children = self._get_children(soup, wanted, url, text_fuzz_ratio)
+        for wanted, title in zip(wanted_list, titles):
+            children = self._get_children(soup, wanted, url, text_fuzz_ratio, index)
 
             for child in children:
                 stack = self._build_stack(child)
+                if title:
+                    stack["title"] = self._build_title_rule(child, title, index)
                 stack_list.append(stack)
 
         stack_list = unique_stack_list(stack_list)
@@ -231,12 +335,12 @@ class OrderedAutoScraper():
         
         if len(stack_list) > 1:
             self.stack_list = self._merge_stacks([], stack_list)
-            result_list = self._get_results_with_stacks(self.stack_list, [soup], url, [], 1.0)
+            result_list = self._get_results_with_stacks(self.stack_list, [soup], url, [], 1.0, with_titles)
         else:
             self.stack_list = stack_list
-            result_list = self._get_result_with_stack(self.stack_list[0], [soup], url, 1.0)
+            result_list = self._get_result_with_stack(self.stack_list[0], [soup], url, 1.0, with_titles)
         
-        return unique_hashable(result_list)
+        return unique_results(result_list, with_titles)
     
     @classmethod
     def _merge_stacks(cls, res, stack_list):
@@ -303,6 +407,71 @@ class OrderedAutoScraper():
         stack["stack_id"] = "rule_" + get_random_str(4)
         return stack
         
+    @classmethod
+    def _build_title_rule(cls, child, title, index=None):
+        """
+        Find the element holding the post's title near the matched one:
+        the best match among descendants of the element and its closest ancestors.
+        Returns a path to it relative to the matched element.
+        """
+        best = None
+        best_ratio = cls.title_ratio_limit
+        node = child
+        for up in range(cls.title_max_up + 1):
+            for cand in [node] + node.find_all(True):
+                text = " ".join((index.text(cand) if index else cand.getText()).split())
+                if not text:
+                    continue
+                matcher = SequenceMatcher(None, title, text)
+                if matcher.real_quick_ratio() <= best_ratio or matcher.quick_ratio() <= best_ratio:
+                    continue
+                ratio = matcher.ratio()
+                if ratio > best_ratio:
+                    best = (up, node, cand)
+                    best_ratio = ratio
+            if not node.parent or not node.parent.parent:
+                break
+            node = node.parent
+
+        if not best:
+            return None
+
+        up, ancestor, cand = best
+        path = []
+        while cand is not ancestor:
+            parent = cand.parent
+            attrs = cls._get_valid_attrs(cand)
+            siblings = parent.findAll(cand.name, attrs, recursive=False)
+            idx = next(i for i, c in enumerate(siblings) if c is cand)
+            path.insert(0, (cand.name, attrs, idx))
+            cand = parent
+        return dict(up=up, path=path)
+
+    @staticmethod
+    def _fetch_title_from_child(child, rule):
+        if not rule:
+            return None
+        node = child
+        for i in range(rule["up"]):
+            node = node.parent
+            if node is None:
+                return None
+        for name, attrs, idx in rule["path"]:
+            found = node.findAll(name, attrs, recursive=False)
+            if not found:
+                return None
+            node = found[min(len(found) - 1, idx)]
+        return " ".join(node.getText().split()) or None
+
+    @classmethod
+    def _fetch_stack_result(cls, child, stack, url, with_titles=False):
+        result = cls._fetch_result_from_child(
+            child, stack["wanted_attr"], stack["is_full_url"], url, stack.get("is_non_rec_text", False)
+        )
+        if with_titles:
+            return (result, cls._fetch_title_from_child(child, stack.get("title")))
+        return result
+
     @staticmethod
     def _fetch_result_from_child(child, wanted_attr, is_full_url, url, is_non_rec_text):
         if wanted_attr is None:
@@ -318,7 +487,7 @@ class OrderedAutoScraper():
 
         return child.attrs[wanted_attr]
         
-    def _get_result_with_stack(self, stack, parents, url, attr_fuzz_ratio=1.0):
+    def _get_result_with_stack(self, stack, parents, url, attr_fuzz_ratio=1.0, with_titles=False):
         stack_content = stack["content"]
         for index, item in enumerate(stack_content):
             children = []
@@ -342,18 +511,13 @@ class OrderedAutoScraper():
 
             parents = children
 
-        wanted_attr = stack["wanted_attr"]
-        is_full_url = stack["is_full_url"]
-        is_non_rec_text = stack.get("is_non_rec_text", False)
         result = [
-                self._fetch_result_from_child(
-                    i, wanted_attr, is_full_url, url, is_non_rec_text
-                )  
+                self._fetch_stack_result(i, stack, url, with_titles)
             for i in parents
         ]
         return result
         
-    def _get_results_with_stacks(self, stacks, parents, url, results=[], attr_fuzz_ratio=1.0):
+    def _get_results_with_stacks(self, stacks, parents, url, results=[], attr_fuzz_ratio=1.0, with_titles=False):
         
         lel = stacks[-1]
         
@@ -399,13 +563,14 @@ class OrderedAutoScraper():
                 continue
             for f in found:
                 if tys[f[1]]:
-                    self._get_results_with_stacks(item[f[1]][1:], [f[0]], url, results, attr_fuzz_ratio)
+                    self._get_results_with_stacks(item[f[1]][1:], [f[0]], url, results, attr_fuzz_ratio, with_titles)
                 else:
                     l = len(item[f[1]]['content'])
-                    if l > 2:
-                        c = item[f[1]].copy()
-                        c['content'].pop(0)
-                        r = self._get_result_with_stack(c, [f[0]], attr_fuzz_ratio)
+                    if l == 1:
+                        results.append(self._fetch_stack_result(f[0], item[f[1]], url, with_titles))
+                    elif l > 2:
+                        c = dict(item[f[1]], content=item[f[1]]['content'][1:])
+                        r = self._get_result_with_stack(c, [f[0]], url, attr_fuzz_ratio, with_titles)
                         results.extend(r)
                     else:
                         st = item[f[1]]['content']
@@ -416,13 +581,7 @@ class OrderedAutoScraper():
                         found2 = f[0].findAll(st[1][0], attrs, recursive=False)
                         if found2:
                             idx = min(len(found2) - 1, st[0][2])
-                            r = found2[idx]
-                            wanted_attr = item[f[1]]["wanted_attr"]
-                            is_full_url = item[f[1]]["is_full_url"]
-                            is_non_rec_text = item[f[1]].get("is_non_rec_text", False)
-                            r = self._fetch_result_from_child(
-                                        r, wanted_attr, is_full_url, url, is_non_rec_text
-                                    )
+                            r = self._fetch_stack_result(found2[idx], item[f[1]], url, with_titles)
                             results.append(r)
                      
         return results
@@ -445,13 +604,13 @@ class OrderedAutoScraper():
 
         self.stack_list = data["stack_list"]
             
-    def get_result_similar(self, url, html=None, attr_fuzz_ratio=1.0):
-        soup = self._get_soup(url=url, html=html)
+    def get_result_similar(self, url, html, attr_fuzz_ratio=1.0, with_titles=False):
+        soup = self._get_soup(html)
         result_list = None
         
         if len(self.stack_list) > 1:
-            result_list = self._get_results_with_stacks(self.stack_list, [soup], url, [], attr_fuzz_ratio)
+            result_list = self._get_results_with_stacks(self.stack_list, [soup], url, [], attr_fuzz_ratio, with_titles)
         else:
-            result_list = self._get_result_with_stack(self.stack_list[0], [soup], url, attr_fuzz_ratio)
+            result_list = self._get_result_with_stack(self.stack_list[0], [soup], url, attr_fuzz_ratio, with_titles)
         
-        return unique_hashable(result_list)
\ No newline at end of file
+        return unique_results(result_list, with_titles)
\ No newline at end of file
@@ -0,0 +1,84 @@
+from html.parser import HTMLParser
+from tgnotifier.utils.http import meta_charset_re
+import codecs
+
+
+class TitleParser(HTMLParser):
+    """
+    Incremental extractor of a page's title.
+    Takes raw body chunks and reports when reading can be stopped:
+    after <title> or og:title is found, or when the <head> is over.
+    """
+
+    sniff_size = 1024
+
+    def __init__(self, charset=None):
+        super().__init__(convert_charrefs=True)
+        self.charset = charset
+        self.decoder = None
+        self.raw = b''
+        self.in_title = False
+        self.parts = []
+        self.title = None
+        self.done = False
+
+    def _get_decoder(self, raw):
+        charset = self.charset
+        if not charset:
+            match = meta_charset_re.search(raw)
+            charset = match.group(1).decode('ascii') if match else 'utf-8'
+        try:
+            return codecs.getincrementaldecoder(charset)(errors='replace')
+        except LookupError:
+            return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def feed_bytes(self, chunk):
+        if self.done:
+            return True
+        if self.decoder is None:
+            self.raw += chunk
+            if len(self.raw) < self.sniff_size:
+                return False
+            self.decoder = self._get_decoder(self.raw)
+            chunk, self.raw = self.raw, b''
+        self.feed(self.decoder.decode(chunk))
+        return self.done
+
+    def close(self):
+        if self.decoder is None:
+            self.decoder = self._get_decoder(self.raw)
+            self.feed(self.decoder.decode(self.raw))
+        self.feed(self.decoder.decode(b'', final=True))
+        super().close()
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == 'title':
+            self.in_title = True
+            self.parts = []
+        elif tag == 'meta':
+            attrs = dict(attrs)
+            if attrs.get('property') == 'og:title' and attrs.get('content'):
+                self._set_title(attrs['content'])
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if tag == 'title' and self.in_title:
+            self.in_title = False
+            self._set_title(''.join(self.parts))
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self.in_title and not self.done:
+            self.parts.append(data)
+
+    def _set_title(self, title):
+        title = ' '.join(title.split())
+        if title:
+            self.title = title
+            self.done = True
@@ -0,0 +1,131 @@
+"""
+Shared asynchronous HTTP client.
+All outgoing scraping requests go through one pooled aiohttp session, so
+connections (and TLS handshakes) are reused and the event loop is never blocked.
+"""
+import asyncio
+import random
+import re
+import aiohttp
+from tgnotifier.core.settings import settings
+from .concurrency import time_left
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+meta_charset_re = re.compile(rb'<meta[^>]+charset=["\']?([-\w.:]+)', re.IGNORECASE)
+
+session = None
+
+
+class HttpError(Exception):
+    pass
+
+
+class Response:
+
+    def __init__(self, url, status, headers, body, charset=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.charset = charset
+
+    def text(self):
+        return decode(self.body, self.charset)
+
+
+def decode(body, charset=None):
+    if not charset:
+        match = meta_charset_re.search(body[:4096])
+        charset = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return body.decode(charset, errors='replace')
+    except LookupError:
+        return body.decode('utf-8', errors='replace')
+
+def get_session():
+    global session
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings.HTTP_POOL_SIZE,
+                limit_per_host=settings.HTTP_POOL_PER_HOST,
+                ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                connect=settings.HTTP_CONNECT_TIMEOUT,
+                sock_read=settings.HTTP_READ_TIMEOUT),
+            headers={'User-Agent': USER_AGENT})
+    return session
+
+async def close_session():
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+
+def backoff(attempt, interval):
+    return interval * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+async def request(url, read, headers=None, params=None, attempts=None, interval=None, statuses=(200,)):
+    """
+    GET `url` and pass the response to the `read` coroutine, returning its result.
+    Network errors and transient statuses are retried with jittered exponential backoff,
+    any other status not in `statuses` fails at once. Raises HttpError when no valid response was got.
+    Requests and retries stop at the deadline of the running task.
+    """
+    attempts = attempts or settings.SCRAPER_ATTEMPTS
+    interval = settings.SCRAPER_INTERVAL if interval is None else interval
+    error = None
+    for i in range(attempts):
+        if i:
+            delay = backoff(i - 1, interval)
+            left = time_left()
+            if left is not None and left <= delay:
+                break
+            await asyncio.sleep(delay)
+        left = time_left()
+        if left is not None and left <= 0:
+            error = HttpError(f'{url}: deadline exceeded')
+            break
+        timeout = None if left is None else aiohttp.ClientTimeout(total=left,
+            connect=settings.HTTP_CONNECT_TIMEOUT, sock_read=settings.HTTP_READ_TIMEOUT)
+        try:
+            async with get_session().get(url, headers=headers, params=params, timeout=timeout) as res:
+                if res.status in statuses:
+                    return await read(res)
+                error = HttpError(f'{url}: status {res.status}')
+                if res.status not in RETRY_STATUSES:
+                    break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = HttpError(f'{url}: {str(e) or type(e).__name__}')
+    raise error
+
+async def read_response(res):
+    return Response(str(res.url), res.status, res.headers, await res.read(), res.charset)
+
+async def get(url, headers=None, params=None, attempts=None, interval=None, statuses=(200,)):
+    """
+    GET `url` and read the whole body.
+    """
+    return await request(url, read_response, headers=headers, params=params,
+        attempts=attempts, interval=interval, statuses=statuses)
+
+async def stream(url, parser_factory, headers=None, attempts=None, interval=None, chunk_size=4096):
+    """
+    GET `url` and feed the body by chunks to a parser made by `parser_factory(charset)`.
+    The connection is dropped as soon as the parser's `feed_bytes` returns True.
+    Returns the parser.
+    """
+    async def read(res):
+        parser = parser_factory(res.charset)
+        async for chunk in res.content.iter_chunked(chunk_size):
+            if parser.feed_bytes(chunk):
+                res.close()
+                return parser
+        parser.close()
+        return parser
+
+    return await request(url, read, headers=headers, attempts=attempts, interval=interval)
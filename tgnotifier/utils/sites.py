@@ -1,38 +1,66 @@
-import time
 from .helpers.scraper import OrderedAutoScraper
-import requests
-from bs4 import BeautifulSoup
+from .helpers.title import TitleParser
+from .helpers.program import extract
+from .concurrency import run_cpu_bound
+from . import http
 from tgnotifier.core.settings import settings
+import asyncio
+import hashlib
+import re
 import validators
 from urllib.parse import urlparse
 
-headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.95 Safari/537.36'}
+headers = {'User-Agent': http.USER_AGENT}
 
-def get_posts_by_stacks(url, stacks):
-    scraper = OrderedAutoScraper()
-    scraper.loadFromStr(stacks)
-    scraper.reconnect_attempts = settings.SCRAPER_ATTEMPTS
-    scraper.reconnect_interval = settings.SCRAPER_INTERVAL
-    return scraper.get_result_similar(url)
+noise_re = re.compile(r'<script\b.*?</script\s*>|<style\b.*?</style\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+spaces_re = re.compile(r'\s+')
+
+async def fetch_page(url, etag=None, last_modified=None, attempts=None):
+    """
+    Conditional GET of a monitored page.
+    The response status is 304 if the page wasn't modified since the validators were got.
+    """
+    request_headers = dict(OrderedAutoScraper.request_headers, Host=urlparse(url).netloc)
+    if etag:
+        request_headers['If-None-Match'] = etag
+    if last_modified:
+        request_headers['If-Modified-Since'] = last_modified
+    try:
+        return await http.get(url, headers=request_headers, attempts=attempts, statuses=(200, 304))
+    except http.HttpError as e:
+        raise Exception(f"Unable to get a valid response from site: {e}")
 
-def make_stacks_by_posts(url, wanted_posts):
+def get_validators(res):
+    return (res.headers.get('ETag'), res.headers.get('Last-Modified'))
+
+def get_fingerprint(stack, html):
+    """
+    Hash of the page body without scripts, styles, comments and whitespace differences,
+    salted with the stack so that editing the stack invalidates it.
+    """
+    body = spaces_re.sub(' ', noise_re.sub('', html))
+    return hashlib.sha256((stack + body).encode('utf-8', errors='replace')).hexdigest()
+
+async def get_posts_by_stacks(url, stacks, html, engine=None):
+    """
+    Parsing and extraction run in the parse workers, if there are any.
+    """
+    return await run_cpu_bound(extract, url, stacks, html, True, engine or settings.SCRAPER_ENGINE)
+
+async def make_stacks_by_posts(url, wanted_posts, wanted_titles=None):
     scraper = OrderedAutoScraper()
     scraper.reconnect_attempts = settings.SCRAPER_ATTEMPTS
     scraper.reconnect_interval = settings.SCRAPER_INTERVAL
-    res = scraper.build(wanted_posts, url)
+    html = await scraper._fetch_html(url)
+    res = await asyncio.to_thread(scraper.build, wanted_posts, url, html,
+        wanted_titles=wanted_titles, with_titles=True)
     return (res, scraper)
 
-def get_title_by_url(url):
-    for i in range(settings.SCRAPER_ATTEMPTS):
-        try:
-            res = requests.get(url, headers=headers)
-            if res.status_code == 200:
-                return BeautifulSoup(res.text, 'lxml').title.string
-            else:
-                time.sleep(settings.SCRAPER_INTERVAL)
-        except:
-            time.sleep(settings.SCRAPER_INTERVAL)
-    return None
+async def get_title_by_url(url):
+    try:
+        return (await http.stream(url, TitleParser, headers=headers)).title
+    except http.HttpError:
+        return None
 
 def clear_ads(url, posts):
     #return [p for p in posts if p.startswith(url)]
@@ -48,5 +76,15 @@ def filter_new_posts(last, new):
             res.append(p)
     return (res, new)
 
+def is_burst(last, posts, new):
+    """
+    Whether the new posts rather look like a changed layout or url scheme of the site than news:
+    none of the page's posts were seen before, or at least FLOOD_SHARE of them are new.
+    Fewer than FLOOD_MIN_POSTS new posts are never a burst.
+    """
+    if not last or len(new) < settings.FLOOD_MIN_POSTS:
+        return False
+    return not any(p[0] in last for p in posts) or len(new) >= settings.FLOOD_SHARE * len(posts)
+
 def is_valid_url(url):
     return validators.url(url)
\ No newline at end of file
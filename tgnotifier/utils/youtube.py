@@ -1,12 +1,14 @@
 from googleapiclient.discovery import build as build_google_api
 from tgnotifier.core.settings import settings
 from tgnotifier.utils.log import log
+import httplib2
 import time
 import re
-import requests as req
+from tgnotifier.utils import http
 
 youtube = build_google_api("youtube", "v3", 
-	developerKey=settings.YOUTUBE_API_KEY.get_secret_value())
+	developerKey=settings.YOUTUBE_API_KEY.get_secret_value(),
+	http=httplib2.Http(timeout=settings.HTTP_READ_TIMEOUT))
 
 def parse_link(link):
 	a = link[24:].split("/")
@@ -80,20 +82,29 @@ def isTitleValid(text, include, exclude):
 		return True
 	return False
 
-def getNewVideosFromPlaylist(id, last, include, exclude):
+def getNewVideosFromPlaylist(id, last, include, exclude, attempts=None):
+	"""
+	Blocking, to be run in a thread. httplib2 isn't thread-safe, so every call has a connection of its own.
+	"""
+	attempts = attempts or 3
 	allv = None
-	for i in range(3):
+	conn = httplib2.Http(timeout=settings.HTTP_READ_TIMEOUT)
+	for i in range(attempts):
 		try:
 			allv = youtube.playlistItems().list(
 		playlistId=id,
 		part="snippet",
 		maxResults=5,
 		pageToken=None
-	).execute()
+	).execute(http=conn)
 			break
-		except:
-			time.sleep(1)
+		except Exception as e:
+			error = e
+			if i + 1 < attempts:
+				time.sleep(1)
 			log("getvideos failed due error")
+	if allv is None:
+		raise Exception(f"Unable to get videos of the playlist: {error}")
 	videos = []
 	newlast=[v['snippet']['resourceId']['videoId'] for v in allv['items']]
 	for v in allv['items']:
@@ -116,27 +127,19 @@ def parseYoutubeQueryPage(html):
     else:
     	return None
 
-def getNewVideosFromSearchQuery(q, lastvideos):
-	r=None
-	for i in range(settings.SCRAPER_ATTEMPTS):
-		try:
-			r = req.get("https://www.youtube.com/results",params={'search_query':q, 'sp':"CAISAhAB"})
-			if r.status_code==200:
-				break
-			else:
-				time.sleep(settings.SCRAPER_INTERVAL)
-				log("getvideosbyquery failed due response")
-		except:
-			time.sleep(settings.SCRAPER_INTERVAL)
-			log("getvideosbyquery failed due error")
-	if r and r.status_code == 200:
-		videos = parseYoutubeQueryPage(r.text)
-		if videos:
-		    l=[]
-		    for v in videos:
-			    if v[0] in lastvideos:
-				    break
-			    else:
-				    l.append(v)
-		    return ([x[0] for x in videos],l)
-	return (lastvideos,[])
\ No newline at end of file
+async def getNewVideosFromSearchQuery(q, lastvideos, attempts=None):
+	try:
+		r = await http.get("https://www.youtube.com/results", params={'search_query':q, 'sp':"CAISAhAB"},
+			attempts=attempts)
+	except http.HttpError as e:
+		raise Exception(f"Unable to get search results: {e}")
+	videos = parseYoutubeQueryPage(r.text())
+	if videos:
+	    l=[]
+	    for v in videos:
+		    if v[0] in lastvideos:
+			    break
+		    else:
+			    l.append(v)
+	    return ([x[0] for x in videos],l)
+	return (lastvideos,[])
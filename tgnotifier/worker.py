@@ -0,0 +1,47 @@
+"""
+Background worker: runs the periodic jobs and sends the outbox in a process of its own,
+without the FastAPI app and the webhook.
+Run with `python -m tgnotifier.worker`, the web process then needs RUN_TASKS=false
+and RUN_SENDER=false. A worker with RUN_TASKS=false only sends notifications.
+"""
+from .core.settings import settings
+from .initial import setup_db
+from .utils.log import log
+from .utils.http import close_session
+from .utils.concurrency import shutdown_executor
+from .telegram.bot import bot
+from .tasks import JOBS
+from .tasks.scheduler import Scheduler
+from .tasks.outbox import drainOutbox
+import asyncio
+import signal
+
+async def run():
+	task = asyncio.current_task()
+	loop = asyncio.get_running_loop()
+	for sig in (signal.SIGTERM, signal.SIGINT):
+		loop.add_signal_handler(sig, task.cancel)
+	tasks = []
+	if settings.RUN_TASKS:
+		log("Running tasks", error=False)
+		tasks.append(asyncio.create_task(Scheduler(JOBS).run()))
+	if settings.RUN_SENDER:
+		tasks.append(asyncio.create_task(drainOutbox()))
+	try:
+		await asyncio.gather(*tasks)
+	except asyncio.CancelledError:
+		log("Stopping tasks", error=False)
+	finally:
+		for t in tasks:
+			t.cancel()
+		await asyncio.gather(*tasks, return_exceptions=True)
+		await close_session()
+		await (await bot.get_session()).close()
+		shutdown_executor()
+
+def main():
+	setup_db()
+	asyncio.run(run())
+
+if __name__ == '__main__':
+	main()